@@ -0,0 +1,95 @@
+import argparse
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import time
+import chess.pgn
+import metrics
+from chess.engine import SimpleEngine
+from engine_profile import EngineProfile
+from generator import Generator, version
+from server import Server
+from typing import List
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_ENGINE = os.path.join(HERE, "fake_engine.py")
+
+def read_games(path: str, limit: int) -> List[str]:
+    "the text of the first `limit` games of `path`, all if 0"
+    with open(path) as pgn:
+        texts: List[str] = []
+        while not limit or len(texts) < limit:
+            offset = pgn.tell()
+            if chess.pgn.read_headers(pgn) is None:
+                break
+            end = pgn.tell()
+            pgn.seek(offset)
+            texts.append(pgn.read(end - offset))
+    return texts
+
+def fake_engine(table: str) -> SimpleEngine:
+    command = [sys.executable, FAKE_ENGINE] + (["--table", table] if table else [])
+    engine = SimpleEngine.popen_uci(command)
+    EngineProfile(threads = 1, hash = 16).configure(engine)
+    return engine
+
+def engine_seconds() -> float:
+    return sum(total for _, total in metrics.ENGINE_SECONDS.snapshot().values())
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='bench.py',
+        description='times the Python side of generator.py on a corpus, against fake_engine.py which answers at once')
+    parser.add_argument("--file", "-f", help="PGN corpus of a few hundred games or more for stable numbers, analysed games being the closest to production", required=True, metavar="FILE.pgn")
+    parser.add_argument("--games", help="count of games of the corpus, 0 for all", type=int, default=0)
+    parser.add_argument("--repeat", help="count of passes over the corpus, each with a cold cache", type=int, default=3)
+    parser.add_argument("--table", help="json file of canned engine lines, see fake_engine.py", metavar="FILE.json")
+    parser.add_argument("--sweep-nodes", help="as for generator.py, only matters for games without evals", type=int, default=0)
+    parser.add_argument("--tier", type=int, default=10)
+    parser.add_argument("--profile", help="print the functions taking the most time", action="store_true")
+    args = parser.parse_args()
+
+    texts = read_games(args.file, args.games)
+    engine = fake_engine(args.table)
+    server = Server(logger, "", "", version)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        for run in range(1, args.repeat + 1):
+            metrics.REGISTRY.reset()
+            generator = Generator(engine, server, sweep_nodes = args.sweep_nodes)
+            generator.not_analysed_warning = True
+            parse = analyse = 0.0
+            plies = puzzles = 0
+            for text in texts:
+                start = time.perf_counter()
+                game = chess.pgn.read_game(io.StringIO(text))
+                parse += time.perf_counter() - start
+                assert game is not None
+                plies += game.end().ply()
+                if profiler is not None:
+                    profiler.enable()
+                start = time.perf_counter()
+                puzzles += generator.analyze_game(game, args.tier) is not None
+                analyse += time.perf_counter() - start
+                if profiler is not None:
+                    profiler.disable()
+            searches = int(sum(metrics.ENGINE_CALLS.snapshot().values()))
+            engine_time = engine_seconds()
+            python = parse + analyse - engine_time
+            print(f"Run {run}: {len(texts)} games, {plies} plies, {puzzles} puzzles, {searches} searches")
+            print(f"  parse    {parse * 1000 / len(texts):8.2f} ms/game {parse * 1e6 / plies:8.1f} us/ply")
+            print(f"  analyse  {analyse * 1000 / len(texts):8.2f} ms/game {analyse * 1e6 / plies:8.1f} us/ply, of which engine round-trips {engine_time / max(analyse, 1e-9):.0%}")
+            print(f"  python   {python * 1000 / len(texts):8.2f} ms/game {python * 1e6 / plies:8.1f} us/ply")
+    finally:
+        engine.quit()
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import io
+import logging
+import time
+import chess.pgn
+from chess.engine import Cp, Score
+from chess.pgn import Game
+from bench import read_games
+from generator import Generator, version
+from server import Server
+from triage import tactic_scores, select_plies
+from util import node_eval
+from typing import List, Set
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+def probed_plies(generator: Generator, game: Game, tier: int) -> Set[int]:
+    "plies the full search would probe, from the evals of the game instead of the engine's"
+    probed = set()
+    prev_score: Score = Cp(20)
+    for node, board in generator.candidate_nodes(game):
+        current_eval = node_eval(node, board.turn)
+        if current_eval is None:
+            continue
+        score = current_eval.pov(board.turn)
+        if generator.probe_kind(node, board, prev_score, score, tier):
+            probed.add(board.ply())
+        prev_score = -score
+    return probed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='bench_triage.py',
+        description='recall of --triage: share of the positions the full search probes that triage keeps, on analysed games whose evals stand in for the engine')
+    parser.add_argument("--file", "-f", help="PGN corpus of a few hundred analysed games or more for stable numbers", required=True, metavar="FILE.pgn")
+    parser.add_argument("--games", help="count of games of the corpus, 0 for all", type=int, default=0)
+    parser.add_argument("--keep", help="comma separated values of --triage", default="0.05,0.1,0.2,0.3,0.5")
+    parser.add_argument("--tier", type=int, default=10)
+    args = parser.parse_args()
+
+    generator = Generator(None, Server(logger, "", "", version)) # type: ignore
+    games: List[Game] = []
+    for text in read_games(args.file, args.games):
+        game = chess.pgn.read_game(io.StringIO(text))
+        assert game is not None
+        games.append(game)
+
+    start = time.perf_counter()
+    scores = [tactic_scores(game) for game in games]
+    seconds = time.perf_counter() - start
+    truth = [probed_plies(generator, game, args.tier) for game in games]
+    plies = sum(len(s) for s in scores)
+    wanted = sum(len(t) for t in truth)
+    print(f"{len(games)} games, {plies} plies, {wanted} probed by the full search, triage {seconds * 1e6 / max(plies, 1):.1f} us/ply")
+    print(f"{'keep':>6} {'plies':>7} {'recall':>7}")
+    for keep in [float(k) for k in args.keep.split(",")]:
+        selected = [select_plies(s, keep) for s in scores]
+        kept = sum(len(s) for s in selected)
+        found = sum(len(t & s) for t, s in zip(truth, selected))
+        print(f"{keep:6.2f} {kept / max(plies, 1):7.1%} {found / max(wanted, 1):7.1%}")
+
+if __name__ == "__main__":
+    main()
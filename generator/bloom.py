@@ -0,0 +1,28 @@
+import hashlib
+import math
+from typing import Iterable
+
+class BloomFilter:
+    """
+    Set membership in a few bits per item: `in` can answer true for an item never added,
+    with probability `error`, but never false for an item that was.
+    """
+
+    def __init__(self, capacity: int, error: float = 0.01) -> None:
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size = 16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
@@ -0,0 +1,271 @@
+import asyncio
+import dataclasses
+from chess import Board, Move
+from chess.engine import SimpleEngine, UciProtocol, Limit, InfoDict, PlayResult
+from chess.polyglot import zobrist_hash
+from collections import OrderedDict
+from evalstore import EvalStore
+from engine_profile import EngineProfile
+from metrics import ENGINE_CALLS, ENGINE_CACHED, ENGINE_NODES, ENGINE_SECONDS, Timer
+from typing import Any, Callable, Dict, Generic, List, Optional, Tuple, TypeVar, Union
+import tracing
+
+Key = Tuple[str, int, Tuple[Any, ...], Optional[int]]
+EngineT = TypeVar("EngineT", SimpleEngine, UciProtocol)
+
+def analyse_kind(root_moves: Optional[List[Move]]) -> str:
+    "what keys an `analyse` search apart, the moves it is restricted to included"
+    return "analyse" if root_moves is None else f"analyse {' '.join(sorted(move.uci() for move in root_moves))}"
+
+class EarlyStop:
+    """
+    Follows the lines of a multipv search depth after depth, and tells when `verdict` about them
+    has been the same for `stable_depths` consecutive depths, from `min_depth` on.
+    `verdict` returns None while it can't tell.
+    """
+
+    def __init__(self, verdict: Callable[[List[InfoDict]], Optional[bool]], lines: int, min_depth: int, stable_depths: int) -> None:
+        self.verdict = verdict
+        self.lines = lines
+        self.min_depth = min_depth
+        self.stable_depths = stable_depths
+        self.current: Dict[int, InfoDict] = {}
+        self.depth = 0 # last depth all lines were seen at
+        self.last: Optional[bool] = None
+        self.stable = 0
+
+    def update(self, info: InfoDict) -> bool:
+        "whether the search can stop after `info`"
+        if "score" not in info or not info.get("pv") or info.get("lowerbound") or info.get("upperbound"):
+            return False
+        multipv = info.get("multipv", 1)
+        self.current[multipv] = info
+        depth = info.get("depth", 0)
+        if multipv != self.lines or depth <= self.depth:
+            return False
+        self.depth = depth
+        verdict = self.verdict([self.current[i] for i in range(1, self.lines + 1) if i in self.current])
+        self.stable = 0 if verdict is None else self.stable + 1 if verdict == self.last else 1
+        self.last = verdict
+        return self.stable >= self.stable_depths and depth >= self.min_depth
+
+
+class EngineCache(Generic[EngineT]):
+    """
+    Results of the last `size` searches of an engine, so that searching again the same position
+    with the same limit is free, whether the engine is driven with threads or asyncio.
+    `kind` is what the search is for, only used in metrics and traces.
+    """
+
+    def __init__(self, engine: EngineT, size: int, store: Optional[EvalStore] = None) -> None:
+        self.engine: EngineT = engine
+        self.size = size
+        self.store = store
+        self.entries: "OrderedDict[Key, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind: str, board: Board, limit: Limit, multipv: Optional[int] = None) -> Key:
+        return (kind, zobrist_hash(board), dataclasses.astuple(limit), multipv)
+
+    def get(self, key: Key) -> Any:
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def put(self, key: Key, result: Any) -> None:
+        if self.size <= 0:
+            return
+        self.entries[key] = result
+        if len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def searching(self, kind: str) -> Timer:
+        ENGINE_CALLS.inc(1, kind)
+        return ENGINE_SECONDS.time(kind)
+
+    def searched(self, kind: str, result: Any, span: Any) -> None:
+        info = result[0] if isinstance(result, list) else result
+        if isinstance(info, dict):
+            if "nodes" in info:
+                ENGINE_NODES.inc(info["nodes"], kind)
+            span.set(**{k: info[k] for k in ("depth", "nodes", "time") if k in info})
+
+    def span(self, kind: str, board: Board, limit: Limit, multipv: Optional[int] = None) -> Any:
+        "trace span of a search, describing it only when the game is traced"
+        if not tracing.active():
+            return tracing.NULL_SPAN
+        limits = {k: v for k, v in dataclasses.asdict(limit).items() if v is not None}
+        return tracing.span("search", kind = kind, fen = board.fen(), limit = limits, multipv = multipv)
+
+    def lookup(self, kind: str, key: Key, store_key: Any, span: Any, multipv: Optional[int] = None) -> Any:
+        "result of the cache, or else of the store"
+        result = self.get(key)
+        if result is None and self.store is not None:
+            result = self.store.get_play(store_key) if key[0] == "play" else self.store.get_analyse(store_key, multipv)
+        if result is not None:
+            ENGINE_CACHED.inc(1, kind)
+            span.set(cached = True)
+        return result
+
+    def waited(self, kind: str, key: Key, span: Any) -> Any:
+        "result another caller kept while this one waited for the engine, after `lookup` missed it"
+        result = self.entries.get(key)
+        if result is not None:
+            self.misses -= 1 # a hit after all
+            self.hits += 1
+            self.entries.move_to_end(key)
+            ENGINE_CACHED.inc(1, kind)
+            span.set(cached = True)
+        return result
+
+    def keep(self, key: Key, store_key: Any, result: Any) -> None:
+        if self.store is not None:
+            if key[0] == "play":
+                self.store.put_play(store_key, result)
+            else:
+                self.store.put_analyse(store_key, result)
+        self.put(key, result)
+
+    def store_key(self, kind: str, board: Board, limit: Limit, multipv: Optional[int] = None) -> Any:
+        return self.store.key(kind, self.engine, board, limit, multipv) if self.store is not None else None
+
+    def stats(self) -> str:
+        stats = f"cache {self.hits} hits / {self.misses} misses"
+        return f"{stats}, {self.store.stats()}" if self.store is not None else stats
+
+
+class CachedEngine(EngineCache[SimpleEngine]):
+    "`EngineCache` in front of a `SimpleEngine`"
+
+    def analyse(self, board: Board, limit: Limit, multipv: Optional[int] = None, kind: str = "other", root_moves: Optional[List[Move]] = None) -> Union[InfoDict, List[InfoDict]]:
+        key = self.key(analyse_kind(root_moves), board, limit, multipv)
+        store_key = self.store_key(analyse_kind(root_moves), board, limit, multipv)
+        with self.span(kind, board, limit, multipv) as span:
+            result = self.lookup(kind, key, store_key, span, multipv)
+            if result is None:
+                with self.searching(kind):
+                    result = self.engine.analyse(board, limit, multipv = multipv, root_moves = root_moves)
+                self.searched(kind, result, span)
+                self.keep(key, store_key, result)
+        return result
+
+    def analyse_until(self, board: Board, limit: Limit, multipv: int, early_stop: Callable[[], EarlyStop], kind: str = "other") -> List[InfoDict]:
+        """
+        `analyse` streaming the search, stopped as soon as `early_stop` allows it. Results are
+        cached apart from complete searches, as shallower than them.
+        """
+        key = self.key("until", board, limit, multipv)
+        store_key = self.store_key("until", board, limit, multipv)
+        with self.span(kind, board, limit, multipv) as span:
+            result = self.lookup(kind, key, store_key, span, multipv)
+            if result is None:
+                stop = early_stop()
+                with self.searching(kind):
+                    with self.engine.analysis(board, limit, multipv = multipv) as analysis:
+                        for info in analysis:
+                            if stop.update(info):
+                                break
+                    analysis.wait()
+                result = analysis.multipv
+                self.searched(kind, result, span)
+                self.keep(key, store_key, result)
+        return result
+
+    def play(self, board: Board, limit: Limit, kind: str = "other") -> PlayResult:
+        key = self.key("play", board, limit)
+        store_key = self.store_key("play", board, limit)
+        with self.span(kind, board, limit) as span:
+            result = self.lookup(kind, key, store_key, span)
+            if result is None:
+                with self.searching(kind):
+                    result = self.engine.play(board, limit)
+                self.searched(kind, result.info, span)
+                self.keep(key, store_key, result)
+        return result
+
+    def new_game(self, profile: EngineProfile) -> None:
+        profile.new_game(self.engine)
+
+    def close(self) -> None:
+        self.engine.close()
+        if self.store is not None:
+            self.store.close()
+
+
+class AsyncCachedEngine(EngineCache[UciProtocol]):
+    """
+    `EngineCache` in front of an asyncio `UciProtocol`. A new command cancels the one
+    in progress, so concurrent callers wait for their turn, and then look again whether
+    one of them searched the same.
+    """
+
+    def __init__(self, engine: UciProtocol, size: int, store: Optional[EvalStore] = None) -> None:
+        super().__init__(engine, size, store)
+        self.lock = asyncio.Lock()
+
+    async def analyse(self, board: Board, limit: Limit, multipv: Optional[int] = None, kind: str = "other", root_moves: Optional[List[Move]] = None) -> Union[InfoDict, List[InfoDict]]:
+        key = self.key(analyse_kind(root_moves), board, limit, multipv)
+        store_key = self.store_key(analyse_kind(root_moves), board, limit, multipv)
+        with self.span(kind, board, limit, multipv) as span:
+            result = self.lookup(kind, key, store_key, span, multipv)
+            if result is None:
+                async with self.lock:
+                    result = self.waited(kind, key, span)
+                    if result is None:
+                        with self.searching(kind):
+                            result = await self.engine.analyse(board, limit, multipv = multipv, root_moves = root_moves)
+                        self.searched(kind, result, span)
+                        self.keep(key, store_key, result)
+        return result
+
+    async def analyse_until(self, board: Board, limit: Limit, multipv: int, early_stop: Callable[[], EarlyStop], kind: str = "other") -> List[InfoDict]:
+        key = self.key("until", board, limit, multipv)
+        store_key = self.store_key("until", board, limit, multipv)
+        with self.span(kind, board, limit, multipv) as span:
+            result = self.lookup(kind, key, store_key, span, multipv)
+            if result is None:
+                async with self.lock:
+                    result = self.waited(kind, key, span)
+                    if result is None:
+                        stop = early_stop()
+                        with self.searching(kind):
+                            with await self.engine.analysis(board, limit, multipv = multipv) as analysis:
+                                async for info in analysis:
+                                    if stop.update(info):
+                                        break
+                            await analysis.wait()
+                        result = analysis.multipv
+                        self.searched(kind, result, span)
+                        self.keep(key, store_key, result)
+        return result
+
+    async def play(self, board: Board, limit: Limit, kind: str = "other") -> PlayResult:
+        key = self.key("play", board, limit)
+        store_key = self.store_key("play", board, limit)
+        with self.span(kind, board, limit) as span:
+            result = self.lookup(kind, key, store_key, span)
+            if result is None:
+                async with self.lock:
+                    result = self.waited(kind, key, span)
+                    if result is None:
+                        with self.searching(kind):
+                            result = await self.engine.play(board, limit)
+                        self.searched(kind, result.info, span)
+                        self.keep(key, store_key, result)
+        return result
+
+    async def new_game(self, profile: EngineProfile) -> None:
+        "as `EngineProfile.new_game`"
+        if profile.clear_hash and "Clear Hash" in self.engine.options:
+            async with self.lock:
+                await self.engine.configure({"Clear Hash": None})
+
+    async def quit(self) -> None:
+        await self.engine.quit()
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,84 @@
+import bisect
+import json
+import logging
+import os
+import time
+from threading import Lock
+from typing import Any, Dict, Optional, Set
+from zst import load_index
+
+INTERVAL = 60 # seconds between checkpoint writes
+
+class Checkpoint:
+    """
+    How far a run went through its file, written every `INTERVAL` seconds so that `--resume`
+    can start right after the last game analysed instead of reading the file again.
+    Games finish out of order with several workers, so the position saved is the one of
+    the last game all games before which are done too.
+    """
+
+    def __init__(self, path: str, file: str, logger: logging.Logger, previous: Optional[Dict[str, Any]] = None) -> None:
+        self.path = path
+        self.file = file
+        self.logger = logger
+        self.lock = Lock()
+        self.offsets: Dict[int, int] = {} # index -> offset of the games dispatched and not done yet
+        self.done: Set[int] = set()
+        self.next = 0 # index of the first game not done yet
+        self.last_write = time.monotonic()
+        self.frames = load_index(file, logger)[1] if file.endswith(".zst") else None
+        previous = previous or {}
+        self.offset: Optional[int] = previous.get("offset")
+        self.games = previous.get("games", 0)
+        self.puzzles = previous.get("puzzles", 0)
+
+    @staticmethod
+    def load(path: str, file: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        if checkpoint["file"] != file:
+            raise ValueError(f"{path} is a checkpoint of {checkpoint['file']}, not {file}")
+        return checkpoint
+
+    def dispatched(self, i: int, offset: int) -> None:
+        with self.lock:
+            self.offsets[i] = offset
+
+    def found(self) -> None:
+        with self.lock:
+            self.puzzles += 1
+
+    def finished(self, i: int) -> None:
+        with self.lock:
+            self.done.add(i)
+            while self.next in self.done:
+                self.done.remove(self.next)
+                self.offset = self.offsets.pop(self.next)
+                self.next += 1
+                self.games += 1
+        if time.monotonic() - self.last_write > INTERVAL:
+            self.write()
+
+    def write(self) -> None:
+        with self.lock:
+            self.last_write = time.monotonic()
+            if self.offset is None:
+                return
+            checkpoint = {
+                "file": self.file,
+                "offset": self.offset, # of the last game done, in the decompressed file for .zst
+                "games": self.games,
+                "puzzles": self.puzzles,
+            }
+            if self.frames is not None:
+                # of the zstd frame holding `offset`, for information
+                frame = max(bisect.bisect_right([d for d, _ in self.frames], self.offset) - 1, 0)
+                checkpoint["compressed_offset"] = self.frames[frame][1]
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp, self.path)
+        self.logger.debug(f"Checkpoint {checkpoint}")
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import time
+import requests
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Any, Deque, Dict, Iterator, List, Set, Tuple
+
+RANGE_SIZE = 1000 # games per lease
+LEASE_SECONDS = 600 # a lease not renewed for that long goes to another worker
+LOG_INTERVAL = 60
+POLL_INTERVAL = 5 # seconds between lease requests while all games are leased
+TIMEOUT = 10
+
+class Coordinator:
+    """
+    Owns the offsets of the games of a file, and leases them by ranges of `range_size` games to
+    `--worker` generators, on this node or others, which read the same file at the same path.
+    Workers renew their leases while they work on them, ranges of a worker that stopped
+    renewing are handed to the next worker asking.
+    """
+
+    def __init__(self, file: str, offsets: List[int], logger: logging.Logger, range_size: int = RANGE_SIZE, lease_seconds: float = LEASE_SECONDS) -> None:
+        self.file = file
+        self.size = os.path.getsize(file)
+        self.logger = logger
+        self.lease_seconds = lease_seconds
+        self.ranges = [offsets[i:i + range_size] for i in range(0, len(offsets), range_size)]
+        self.pending: Deque[int] = deque(range(len(self.ranges)))
+        self.leases: Dict[int, Tuple[str, float]] = {} # range -> (worker, expiry)
+        self.done: Set[int] = set()
+        self.workers: Dict[str, Dict[str, Any]] = {} # last progress of each worker
+        self.lock = Lock()
+        self.started = time.monotonic()
+
+    def reclaim(self, now: float) -> None:
+        for range_id, (worker, expiry) in list(self.leases.items()):
+            if expiry < now:
+                self.logger.warning(f"Lease of range {range_id} by {worker} expired")
+                del self.leases[range_id]
+                self.pending.appendleft(range_id)
+
+    def lease(self, worker: str) -> Dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            self.reclaim(now)
+            if not self.pending:
+                if not self.leases:
+                    return {"done": True}
+                return {"wait": min(expiry for _, expiry in self.leases.values()) - now}
+            range_id = self.pending.popleft()
+            self.leases[range_id] = (worker, now + self.lease_seconds)
+            self.logger.info(f"Range {range_id} leased to {worker}")
+            return {"range": range_id, "offsets": self.ranges[range_id]}
+
+    def progress(self, worker: str, report: Dict[str, Any]) -> None:
+        "renew the leases of `worker` and keep its last report. Ranges leased to another worker since stay theirs"
+        with self.lock:
+            self.workers[worker] = {**report, "at": time.monotonic()}
+            for range_id in report.get("ranges", []):
+                if range_id in self.leases and self.leases[range_id][0] == worker:
+                    self.leases[range_id] = (worker, time.monotonic() + self.lease_seconds)
+
+    def complete(self, worker: str, range_id: int) -> None:
+        with self.lock:
+            self.leases.pop(range_id, None)
+            if range_id in self.pending: # reclaimed in the meantime, but done anyway
+                self.pending.remove(range_id)
+            self.done.add(range_id)
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            active = {w: r for w, r in self.workers.items() if now - r["at"] < self.lease_seconds}
+            return {
+                "file": self.file,
+                "size": self.size,
+                "ranges": len(self.ranges),
+                "done": len(self.done),
+                "leased": len(self.leases),
+                "games": sum(r.get("games", 0) for r in self.workers.values()),
+                "puzzles": sum(r.get("puzzles", 0) for r in self.workers.values()),
+                "workers": len(active),
+                "knps": sum(r.get("knps", 0) for r in active.values()),
+                "elapsed": round(now - self.started),
+            }
+
+    def serve(self, host: str, port: int) -> None:
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def reply(self, body: Dict[str, Any]) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                if self.path == "/status":
+                    return self.reply(coordinator.status())
+                self.send_error(404)
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                worker = body.get("worker", self.client_address[0])
+                if self.path == "/lease":
+                    return self.reply({"size": coordinator.size, "lease_seconds": coordinator.lease_seconds, **coordinator.lease(worker)})
+                if self.path == "/progress":
+                    coordinator.progress(worker, body)
+                    return self.reply({})
+                if self.path == "/complete":
+                    coordinator.complete(worker, body["range"])
+                    return self.reply({})
+                self.send_error(404)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass # leases and progress are logged by the coordinator
+
+        def log_status() -> None:
+            while True:
+                time.sleep(LOG_INTERVAL)
+                self.logger.info(f"Status {self.status()}")
+
+        Thread(target = log_status, daemon = True).start()
+        self.logger.info(f"Coordinating {len(self.ranges)} ranges of {self.file} on {host}:{port}")
+        with ThreadingHTTPServer((host, port), Handler) as server:
+            server.serve_forever()
+
+
+class RemoteRanges:
+    """
+    Client side of a `Coordinator`: the offsets of the ranges leased one after the other,
+    for the generator to dispatch. It follows the games of each range as they are done,
+    completes the range after its last one, and renews the leases in the meantime.
+    """
+
+    def __init__(self, url: str, file: str, worker: str, logger: logging.Logger, knps = lambda: 0) -> None:
+        self.url = url.rstrip("/")
+        self.file = file
+        self.worker = worker
+        self.logger = logger
+        self.knps = knps
+        self.lock = Lock()
+        self.range_of: Dict[int, int] = {} # game index -> range
+        self.remaining: Dict[int, int] = {} # range -> games not done yet
+        self.games = 0
+        self.puzzles = 0
+        self.next = 0 # index of the next game dispatched
+        self.lease_seconds = LEASE_SECONDS # as told by the coordinator
+        self.check_file()
+        Thread(target = self.heartbeat, daemon = True).start()
+
+    def check_file(self) -> None:
+        "raises before any game is dispatched when the file isn't the one of the coordinator"
+        while True:
+            try:
+                r = requests.get(f"{self.url}/status", timeout = TIMEOUT)
+                r.raise_for_status()
+                size = r.json()["size"]
+                break
+            except Exception as e:
+                self.logger.error(f"Couldn't reach the coordinator: {e}")
+                time.sleep(TIMEOUT)
+        if size != os.path.getsize(self.file):
+            raise ValueError(f"{self.file} isn't the file of the coordinator, its size differs")
+
+    def post(self, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        r = requests.post(f"{self.url}{path}", json = {"worker": self.worker, **body}, timeout = TIMEOUT)
+        r.raise_for_status()
+        return r.json()
+
+    def __iter__(self) -> Iterator[int]:
+        while True:
+            try:
+                lease = self.post("/lease", {})
+            except Exception as e:
+                self.logger.error(f"Couldn't lease games: {e}")
+                time.sleep(TIMEOUT)
+                continue
+            self.lease_seconds = lease["lease_seconds"]
+            if lease.get("done"):
+                return
+            if "wait" in lease:
+                # the last games may be done soon, or leased again
+                time.sleep(min(max(lease["wait"], 1), POLL_INTERVAL))
+                continue
+            range_id, offsets = lease["range"], lease["offsets"]
+            self.logger.info(f"Leased range {range_id}, {len(offsets)} games")
+            with self.lock:
+                self.remaining[range_id] = len(offsets)
+                for i in range(self.next, self.next + len(offsets)):
+                    self.range_of[i] = range_id
+            for offset in offsets:
+                self.next += 1
+                yield offset
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"ranges": list(self.remaining), "games": self.games, "puzzles": self.puzzles, "knps": self.knps()}
+
+    def heartbeat(self) -> None:
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            try:
+                self.post("/progress", self.report())
+            except Exception as e:
+                self.logger.error(f"Couldn't report progress: {e}")
+
+    # same interface as `Checkpoint`
+
+    def dispatched(self, i: int, offset: int) -> None:
+        pass
+
+    def found(self) -> None:
+        with self.lock:
+            self.puzzles += 1
+
+    def finished(self, i: int) -> None:
+        with self.lock:
+            self.games += 1
+            range_id = self.range_of.pop(i)
+            self.remaining[range_id] -= 1
+            if self.remaining[range_id]:
+                return
+            del self.remaining[range_id]
+        try:
+            self.post("/complete", {"range": range_id})
+            self.post("/progress", self.report())
+            self.logger.info(f"Completed range {range_id}")
+        except Exception as e:
+            self.logger.error(f"Couldn't complete range {range_id}, it will be leased again: {e}")
+
+    def write(self) -> None:
+        try:
+            self.post("/progress", self.report())
+        except Exception as e:
+            self.logger.error(f"Couldn't report progress: {e}")
@@ -0,0 +1,52 @@
+import argparse
+import json
+from dataclasses import dataclass, field, fields, replace
+from chess.engine import SimpleEngine, UciProtocol
+from typing import Any, Dict, Optional, Union
+
+# Kept identical in generator/ and tagger/, so that both search with the same engine settings (checked by tagger/test.py)
+
+@dataclass
+class EngineProfile:
+    """
+    UCI options of an analysis engine, and whether its hash is cleared between games
+    or kept warm from one to the next.
+    MultiPV isn't one of them, python-chess sets it for each search.
+    """
+    threads: int = 4
+    hash: int = 64 # MiB, of each engine process
+    clear_hash: bool = False
+    options: Dict[str, Any] = field(default_factory = dict) # any other UCI option, as is
+
+    def uci_options(self, engine: Union[SimpleEngine, UciProtocol]) -> Dict[str, Any]:
+        "the options to configure `engine` with, leaving out the ones it doesn't have"
+        options = {"Threads": self.threads, "Hash": self.hash, **self.options}
+        return {name: value for name, value in options.items() if name in engine.options}
+
+    def configure(self, engine: SimpleEngine) -> None:
+        engine.configure(self.uci_options(engine))
+
+    def new_game(self, engine: SimpleEngine) -> None:
+        "to call before the searches of each game"
+        if self.clear_hash and "Clear Hash" in engine.options:
+            engine.configure({"Clear Hash": None})
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    "engine options read by `profile_of`, except threads, whose flag differs between tools"
+    parser.add_argument("--engine-config", help="json file of engine settings: threads, hash, clear_hash and options, a dict of any other UCI option. Flags take precedence", metavar="FILE.json")
+    parser.add_argument("--hash", help="Hash of each engine, in MiB (default 64). Every engine process has its own: N workers take N times this memory", type=int)
+    parser.add_argument("--clear-hash", help="clear the engine hash before each game, instead of keeping it warm", action="store_true", default=None)
+
+def profile_of(args: argparse.Namespace, threads: Optional[int], default: EngineProfile = EngineProfile()) -> EngineProfile:
+    "`default`, or the profile of the `--engine-config` file, overridden by the flags given"
+    profile = default
+    if args.engine_config:
+        with open(args.engine_config) as f:
+            config = json.load(f)
+        unknown = set(config) - {f.name for f in fields(EngineProfile)}
+        if unknown:
+            raise ValueError(f"Unknown engine settings in {args.engine_config}: {', '.join(unknown)}")
+        profile = EngineProfile(**config)
+    overrides = {"threads": threads, "hash": args.hash, "clear_hash": args.clear_hash}
+    return replace(profile, **{k: v for k, v in overrides.items() if v is not None})
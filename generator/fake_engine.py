@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import sys
+import zlib
+import chess
+from chess import Board, Move
+from util import material_diff
+from typing import Dict, List, Tuple
+
+DEPTH = 20 # reported when `go` doesn't ask for a depth
+NODES = 10_000 # reported per search, whatever the limit
+
+# lines of a position: (score, as in an info line, pv)
+Lines = List[Tuple[str, List[str]]]
+
+def read_table(path: str) -> Dict[str, Lines]:
+    """
+    Lines by EPD, the best first: {epd: [{"score": "cp 300" or "mate 2", "pv": [uci moves]}, ...]}
+    """
+    with open(path) as f:
+        table = json.load(f)
+    return {epd: [(line["score"], line["pv"]) for line in lines] for epd, lines in table.items()}
+
+def scored_lines(board: Board) -> Lines:
+    """
+    Every legal move, mates in one first, then by material after the move, with a few
+    centipawns from a hash of the position and move so that moves rarely tie. The same
+    position always gets the same lines.
+    """
+    scored = []
+    fen = board.fen()
+    for move in board.legal_moves:
+        uci = move.uci()
+        board.push(move)
+        if board.is_checkmate():
+            scored.append((1_000_000, "mate 1", [uci]))
+        else:
+            cp = -100 * material_diff(board, board.turn) + zlib.crc32(f"{fen} {uci}".encode()) % 41 - 20
+            scored.append((cp, f"cp {cp}", [uci]))
+        board.pop()
+    scored.sort(key = lambda line: (-line[0], line[2]))
+    return [(score, pv) for _, score, pv in scored]
+
+def set_position(tokens: List[str]) -> Board:
+    if tokens[1] == "startpos":
+        board, rest = Board(), tokens[2:]
+    else:
+        board, rest = Board(" ".join(tokens[2:8])), tokens[8:]
+    if rest and rest[0] == "moves":
+        for uci in rest[1:]:
+            board.push(Move.from_uci(uci))
+    return board
+
+def go(board: Board, tokens: List[str], multipv: int, table: Dict[str, Lines]) -> None:
+    depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else DEPTH
+    lines = table.get(board.epd()) or scored_lines(board)
+    if "searchmoves" in tokens:
+        allowed = tokens[tokens.index("searchmoves") + 1:]
+        lines = [line for line in lines if line[1][0] in allowed]
+    for i, (score, pv) in enumerate(lines[:multipv], 1):
+        print(f"info depth {depth} seldepth {depth} multipv {i} score {score} nodes {NODES} nps {NODES * 1000} time 1 pv {' '.join(pv)}")
+    print(f"bestmove {lines[0][1][0] if lines else '(none)'}", flush = True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='fake_engine.py',
+        description='deterministic UCI engine answering at once, for benchmarks and tests')
+    parser.add_argument("--table", help="json file of the lines to answer for given positions, see `read_table`", metavar="FILE.json")
+    args = parser.parse_args()
+    table = read_table(args.table) if args.table else {}
+
+    board = Board()
+    multipv = 1
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            print("id name Fake")
+            print("id author lichess-puzzler")
+            print("option name Threads type spin default 1 min 1 max 512")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("option name Clear Hash type button")
+            print("option name MultiPV type spin default 1 min 1 max 500")
+            print("uciok", flush = True)
+        elif command == "isready":
+            print("readyok", flush = True)
+        elif command == "setoption" and tokens[2] == "MultiPV":
+            multipv = int(tokens[4])
+        elif command == "position":
+            board = set_position(tokens)
+        elif command == "go":
+            go(board, tokens, multipv, table)
+        elif command == "quit":
+            break
+        # ucinewgame, stop (searches are over before it comes) and other options: nothing to do
+
+if __name__ == "__main__":
+    main()
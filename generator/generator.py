@@ -3,20 +3,41 @@ import argparse
 import chess
 import chess.pgn
 import chess.engine
-import copy
 import sys
-import util
-import zstandard
+import os
+import socket
+import metrics
+import tracing
+import io
+import asyncio
+import typing
 from model import Puzzle, NextMovePair
-from io import StringIO
-from chess import Move, Color
-from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
+from chess import Board, Move, Color
+from chess.engine import SimpleEngine, UciProtocol, InfoDict, Mate, Cp, Score, PovScore
 from chess.pgn import Game, ChildNode
 
 from pathlib import Path
-from typing import List, Optional, Union, Set
-from util import count_mates, get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances
-from server import Server
+from typing import Any, BinaryIO, Callable, Dict, Generic, Iterable, Iterator, List, NamedTuple, Optional, TypeVar, Union, Set, Tuple
+import queue
+from multiprocessing import Process, Queue
+from threading import Thread
+from functools import partial
+from contextvars import copy_context
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor
+from util import node_eval, non_mating_moves, next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances
+from server import Server, BLOOM_TTL
+from cache import EngineCache, CachedEngine, AsyncCachedEngine, EarlyStop
+from evalstore import EvalStore
+from zst import SeekableZstd, load_index
+from scan import scan_headers, movetext_scores
+from triage import tactic_scores, select_plies
+from sink import FORMATS
+from checkpoint import Checkpoint
+from coordinator import Coordinator, RemoteRanges
+from engine_profile import EngineProfile, profile_of, add_arguments as add_engine_arguments
+from replay import open_engine, add_arguments as add_replay_arguments
+from tablebase import Tablebase, open_tablebase, add_arguments as add_tablebase_arguments
 
 version = "48WC9" # Was made for the World Championship first
 
@@ -26,16 +47,137 @@ logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%
 eval_limit = chess.engine.Limit(depth = 15, time = 30, nodes = 10_000_000) # when the move isn't analysed
 pair_limit = chess.engine.Limit(depth = 50, time = 30, nodes = 30_000_000)
 mate_defense_limit = chess.engine.Limit(depth = 15, time = 10, nodes = 10_000_000)
+# a move without eval is first looked at with `--sweep-nodes`, then again with `eval_limit`
+# only if its score could start a puzzle (or precedes one that could)
+sweep_mate = Mate(30)
+sweep_cp = Cp(150)
+sweep_swing = 0.45
 
 mate_soon = Mate(15)
 
-class Generator:
-    def __init__(self, engine: SimpleEngine, server: Server):
+attack_margin = 0.7 # win chances the best move must be ahead of the second by
+# with --adaptive, searches for an attack stop once the margin has clearly been met or
+# missed by `adaptive_slack` for `adaptive_stable_depths` depths in a row
+adaptive_slack = 0.1
+adaptive_min_depth = 16
+adaptive_stable_depths = 4
+
+queue_size = 256 # games waiting to be analysed
+
+# with --triage, plies around the likeliest ones which are probed too
+triage_neighbours = 1
+
+def attack_verdict(winner: Color, lines: List[InfoDict]) -> Optional[bool]:
+    "whether the best line is clearly the only one, or clearly not, None if it's too close to tell"
+    if len(lines) < 2:
+        return True
+    best, second = (line["score"].pov(winner) for line in lines[:2])
+    if best.is_mate() and second.is_mate():
+        return None # mates in one are looked at more closely
+    margin = win_chances(best) - win_chances(second)
+    if margin > attack_margin + adaptive_slack:
+        return True
+    if margin < attack_margin - adaptive_slack:
+        return False
+    return None
+
+def swing_plies(scores: List[Tuple[int, Score]]) -> Set[int]:
+    """
+    Plies of a swept game worth searching again: the ones whose score swings almost enough
+    to be probed, and the ones before them, which the probe compares them to.
+    `scores` are (ply, score for the side to move) along the game.
+    """
+    plies: Set[int] = set()
+    prev_score: Score = Cp(20)
+    prev_ply: Optional[int] = None
+    for ply, score in scores:
+        if score > sweep_mate or (score >= sweep_cp and win_chances(score) > win_chances(prev_score) + sweep_swing):
+            plies.add(ply)
+            if prev_ply is not None:
+                plies.add(prev_ply)
+        prev_score = -score
+        prev_ply = ply
+    return plies
+
+def is_swing(prev_score: Score, score: Score) -> bool:
+    "whether the eval of a move is a swing that could start a puzzle, before looking at the position"
+    return score > mate_soon or (score >= Cp(200) and win_chances(score) > win_chances(prev_score) + 0.6)
+
+def has_swing(scores: List[Score]) -> bool:
+    """
+    Whether a move of a game with these evals could start a puzzle. Unlike `Generator.analyze_game`
+    it compares each eval with the one right before, as it doesn't know the positions: plies
+    `Generator.candidate_nodes` skips, repetitions and positions after castling rights were lost,
+    aren't skipped here. The first swing after them may be judged differently, and the game left
+    out, unless `--parse-all`.
+    """
+    prev_score: Score = Cp(20)
+    for score in scores:
+        if is_swing(prev_score, score):
+            return True
+        prev_score = -score
+    return False
+
+def early_stop(winner: Color, lines: int) -> Callable[[], EarlyStop]:
+    return lambda: EarlyStop(partial(attack_verdict, winner), lines, adaptive_min_depth, adaptive_stable_depths)
+
+class EngineCall(NamedTuple):
+    "a call of the cached engine, `method` by name, which a step of `BaseGenerator` waits for"
+    method: str
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+
+class BlockingCall(NamedTuple):
+    "a call of `f` which blocks, to the server most often, which a step of `BaseGenerator` waits for"
+    f: Callable[..., Any]
+    args: Tuple[Any, ...]
+
+Call = Union[EngineCall, BlockingCall]
+T = TypeVar("T")
+E = TypeVar("E", bound = EngineCache)
+# yields the calls it needs, and is sent their results, see `Generator.run` and `AsyncGenerator.run`
+Steps = typing.Generator[Call, Any, T]
+
+def engine_call(method: str, *args: Any, **kwargs: Any) -> EngineCall:
+    return EngineCall(method, args, kwargs)
+
+def blocking_call(f: Callable[..., Any], *args: Any) -> BlockingCall:
+    return BlockingCall(f, args)
+
+class BaseGenerator(Generic[E]):
+    """
+    How puzzles are found, whatever drives the engine: the methods ending in `_steps` don't
+    call the engine or the server themselves, they yield the calls they need and go on
+    with their results, so that `Generator` makes them right away and `AsyncGenerator`
+    awaits them.
+    """
+
+    def __init__(self, engine: E, server: Server, adaptive: bool = False, sweep_nodes: int = 0, profile: Optional[EngineProfile] = None, triage: float = 1, tablebase: Optional[Tablebase] = None):
         self.engine = engine
         self.server = server
+        self.profile = profile or EngineProfile()
+        self.adaptive = adaptive
+        self.sweep_limit = chess.engine.Limit(nodes = sweep_nodes) if sweep_nodes else None
+        self.triage = triage
+        self.tablebase = tablebase
         self.not_analysed_warning = False
 
-    def is_valid_mate_in_one(self, pair: NextMovePair) -> bool:
+    def tablebase_pair(self, board: Board) -> Optional[List[InfoDict]]:
+        "the two best moves of `board` from the tablebases, None if they don't cover it"
+        lines = self.tablebase.lines(board, 2) if self.tablebase else None
+        if lines is not None:
+            metrics.TABLEBASE.inc(1, "pair")
+        return lines
+
+    def analyse_pair_steps(self, board: Board, winner: Color) -> Steps[List[InfoDict]]:
+        lines = self.tablebase_pair(board)
+        if lines is not None:
+            return lines
+        if self.adaptive and board.turn == winner:
+            return (yield engine_call("analyse_until", board, pair_limit, 2, early_stop(winner, min(board.legal_moves.count(), 2)), kind = "pair"))
+        return (yield engine_call("analyse", board, multipv = 2, limit = pair_limit, kind = "pair"))
+
+    def is_valid_mate_in_one_steps(self, pair: NextMovePair) -> Steps[bool]:
         if pair.best.score != Mate(1):
             return False
         non_mate_win_threshold = 0.6
@@ -44,56 +186,75 @@ class Generator:
         if pair.second.score == Mate(1):
             # if there's more than one mate in one, gotta look if the best non-mating move is bad enough
             logger.debug('Looking for best non-mating move...')
-            mates = count_mates(copy.deepcopy(pair.node.board()))
-            info = self.engine.analyse(pair.node.board(), multipv = mates + 1, limit = pair_limit)
-            scores =  [pv["score"].pov(pair.winner) for pv in info]
-            # the first non-matein1 move is the last element
-            if scores[-1] < Mate(1) and win_chances(scores[-1]) > non_mate_win_threshold:
+            others = non_mating_moves(pair.board)
+            if not others:
+                return True
+            info = yield engine_call("analyse", pair.board, limit = pair_limit, kind = "mate_in_one", root_moves = others)
+            score = info["score"].pov(pair.winner)
+            if score < Mate(1) and win_chances(score) > non_mate_win_threshold:
                     return False
             return True
         return False
 
     # is pair.best the only continuation?
-    def is_valid_attack(self, pair: NextMovePair) -> bool:
+    def is_valid_attack_steps(self, pair: NextMovePair) -> Steps[bool]:
         return (
             pair.second is None or
-            self.is_valid_mate_in_one(pair) or
-            win_chances(pair.best.score) > win_chances(pair.second.score) + 0.7
+            (yield from self.is_valid_mate_in_one_steps(pair)) or
+            win_chances(pair.best.score) > win_chances(pair.second.score) + attack_margin
         )
 
-    def get_next_pair(self, node: ChildNode, winner: Color) -> Optional[NextMovePair]:
-        pair = get_next_move_pair(self.engine, node, winner, pair_limit)
-        if node.board().turn == winner and not self.is_valid_attack(pair):
+    def get_next_pair_steps(self, board: Board, winner: Color) -> Steps[Optional[NextMovePair]]:
+        pair = next_move_pair((yield from self.analyse_pair_steps(board, winner)), board, winner)
+        if board.turn == winner and not (yield from self.is_valid_attack_steps(pair)):
             logger.debug("No valid attack {}".format(pair))
             return None
         return pair
 
-    def get_next_move(self, node: ChildNode, limit: chess.engine.Limit) -> Optional[Move]:
-        result = self.engine.play(node.board(), limit = limit)
+    def get_next_move_steps(self, board: Board, limit: chess.engine.Limit) -> Steps[Optional[Move]]:
+        result = yield engine_call("play", board, limit = limit, kind = "defense")
         return result.move if result else None
 
-    def cook_mate(self, node: ChildNode, winner: Color) -> Optional[List[Move]]:
+    def analyse_mate_steps(self, board: Board, mate: Optional[int]) -> Steps[List[InfoDict]]:
+        "the two best moves of the attacker, the search stopping as soon as it proves a mate in `mate` moves or less"
+        limit = replace(pair_limit, mate = mate) if mate else pair_limit
+        return (yield engine_call("analyse", board, multipv = 2, limit = limit, kind = "mate"))
 
-        board = node.board()
+    def cook_mate_steps(self, board: Board, winner: Color, mate: Optional[int] = None, reply: Optional[Move] = None) -> Steps[Optional[List[Move]]]:
+        """
+        Moves of the mate `winner` has in `board`, expected in `mate` moves. The defender plays the `reply`
+        the attacker's search expected, only searched for when there is none. Tablebases are no help
+        here, knowing nothing of mate distances.
+        """
 
         if board.is_game_over():
             return []
 
         if board.turn == winner:
-            pair = self.get_next_pair(node, winner)
-            if not pair:
+            info = yield from self.analyse_mate_steps(board, mate)
+            pair = next_move_pair(info, board, winner)
+            if not (yield from self.is_valid_attack_steps(pair)):
+                logger.debug("No valid attack {}".format(pair))
                 return None
             if pair.best.score < mate_soon:
                 logger.debug("Best move is not a mate, we're probably not searching deep enough")
                 return None
             move = pair.best.move
+            pv = info[0]["pv"]
+            reply = pv[1] if len(pv) > 1 else None
+            mate = pair.best.score.mate()
+            mate = mate - 1 if mate else None
+        elif reply is not None and board.is_legal(reply):
+            move = reply
         else:
-            next = self.get_next_move(node, mate_defense_limit)
+            next = yield from self.get_next_move_steps(board, mate_defense_limit)
             if not next:
                 return None
             move = next
 
-        follow_up = self.cook_mate(node.add_main_variation(move), winner)
+        board.push(move)
+        follow_up = yield from self.cook_mate_steps(board, winner, mate, reply)
+        board.pop()
 
         if follow_up is None:
             return None
@@ -101,22 +262,22 @@ class Generator:
         return [move] + follow_up
 
 
-    def cook_advantage(self, node: ChildNode, winner: Color) -> Optional[List[NextMovePair]]:
-
-        board = node.board()
+    def cook_advantage_steps(self, board: Board, winner: Color) -> Steps[Optional[List[NextMovePair]]]:
 
         if board.is_repetition(2):
             logger.debug("Found repetition, canceling")
             return None
 
-        pair = self.get_next_pair(node, winner)
+        pair = yield from self.get_next_pair_steps(board, winner)
         if not pair:
             return []
         if pair.best.score < Cp(200):
             logger.debug("Not winning enough, aborting")
             return None
 
-        follow_up = self.cook_advantage(node.add_main_variation(pair.best.move), winner)
+        board.push(pair.best.move)
+        follow_up = yield from self.cook_advantage_steps(board, winner)
+        board.pop()
 
         if follow_up is None:
             return None
@@ -124,11 +285,100 @@ class Generator:
         return [pair] + follow_up
 
 
-    def analyze_game(self, game: Game, tier: int) -> Optional[Puzzle]:
+    def analyze_game_steps(self, game: Game, tier: int) -> Steps[Optional[Puzzle]]:
 
         logger.debug(f'Analyzing tier {tier} {game.headers.get("Site")}...')
 
+        yield blocking_call(self.prefetch_seen, game)
+        # the searches of a game then go along it, each warming the hash for the next ones
+        yield engine_call("new_game", self.profile)
+
         prev_score: Score = Cp(20)
+        swept: Optional[Dict[int, PovScore]] = None
+        probed: Optional[Set[int]] = None
+
+        for node, board in self.candidate_nodes(game):
+            current_eval = node_eval(node, board.turn)
+
+            if not current_eval:
+                self.warn_not_analysed(board)
+                if probed is None:
+                    probed = self.triaged(game)
+                if board.ply() not in probed and board.ply() + 1 not in probed:
+                    continue
+                if swept is None:
+                    swept = yield from self.sweep_steps(game, probed)
+                current_eval = swept.get(board.ply())
+                if current_eval is None:
+                    current_eval = (yield engine_call("analyse", board, eval_limit, kind = "eval"))["score"]
+                if board.ply() not in probed:
+                    # only what the next ply is compared to
+                    prev_score = -current_eval.pov(board.turn)
+                    continue
+
+            result = yield from self.analyze_position_steps(node, prev_score, current_eval, tier, board)
+
+            if isinstance(result, Puzzle):
+                return result
+
+            prev_score = -result
+
+        logger.debug("Found nothing from {}".format(game.headers.get("Site")))
+
+        return None
+
+    def prefetch_seen(self, game: Game) -> None:
+        """
+        Ask the server at once about the positions of `game` whose eval swings enough to
+        be probed, instead of one request per probe. Stops at the first move without eval.
+        """
+        if not self.server.url:
+            return
+        ids = []
+        prev_score: Score = Cp(20)
+        for node, board in self.candidate_nodes(game):
+            current_eval = node_eval(node, board.turn)
+            if current_eval is None:
+                break
+            score = current_eval.pov(board.turn)
+            if is_swing(prev_score, score):
+                ids.append(self.server.position_id(board))
+            prev_score = -score
+        self.server.are_seen(ids)
+
+    def triaged(self, game: Game) -> Set[int]:
+        "plies of `game` to probe when they have no eval, with `--triage` only the likeliest to start a tactic"
+        if self.triage >= 1:
+            return set(range(game.end().ply() + 1))
+        return select_plies(tactic_scores(game), self.triage, triage_neighbours)
+
+    def sweep_steps(self, game: Game, probed: Set[int]) -> Steps[Dict[int, PovScore]]:
+        """
+        Cheap scores of the moves of `game` without eval, searched in order so that the engine hash
+        carries over from one to the next, by ply. Only the `probed` plies and the ones before them
+        are searched. Plies around a swing are left out, to be searched with `eval_limit`.
+        Empty if sweeping is off.
+        """
+        if self.sweep_limit is None:
+            return {}
+        evals: Dict[int, PovScore] = {}
+        scores: List[Tuple[int, Score]] = []
+        for node, board in self.candidate_nodes(game):
+            current_eval = node_eval(node, board.turn)
+            if current_eval is None and board.ply() not in probed and board.ply() + 1 not in probed:
+                continue
+            if current_eval is None:
+                current_eval = evals[board.ply()] = (yield engine_call("analyse", board, self.sweep_limit, kind = "sweep"))["score"]
+            scores.append((board.ply(), current_eval.pov(board.turn)))
+        deep = swing_plies(scores)
+        logger.debug(f"Swept {len(evals)} moves, {len(deep)} to search again")
+        return {ply: score for ply, score in evals.items() if ply not in deep}
+
+    def candidate_nodes(self, game: Game) -> Iterator[Tuple[ChildNode, Board]]:
+        """
+        Mainline nodes worth analysing, skipping repetitions and positions after castling rights were lost,
+        along with the board after their move. It is the same board for all nodes, pushed along the game.
+        """
         seen_epds: Set[str] = set()
         board = game.board()
         skip_until_irreversible = False
@@ -142,15 +392,6 @@ class Generator:
                     board.push(node.move)
                     continue
 
-            current_eval = node.eval()
-
-            if not current_eval:
-                if not self.not_analysed_warning:
-                    logger.warning("Game not already analysed by stockfish, will make one but consider using already analysed games from Lichess")
-                    self.not_analysed_warning = True
-                logger.debug("Move without eval on ply {}, computing...".format(node.ply()))
-                current_eval = self.engine.analyse(node.board(), eval_limit)["score"]
-
             board.push(node.move)
             epd = board.epd()
             if epd in seen_epds:
@@ -161,76 +402,164 @@ class Generator:
             if board.castling_rights != maximum_castling_rights(board):
                 continue
 
-            result = self.analyze_position(node, prev_score, current_eval, tier)
+            yield node, board
 
-            if isinstance(result, Puzzle):
-                return result
+    def warn_not_analysed(self, board: Board) -> None:
+        if not self.not_analysed_warning:
+            logger.warning("Game not already analysed by stockfish, will make one but consider using already analysed games from Lichess")
+            self.not_analysed_warning = True
+        logger.debug("Move without eval on ply {}, computing...".format(board.ply()))
 
-            prev_score = -result
-
-        logger.debug("Found nothing from {}".format(game.headers.get("Site")))
-
-        return None
 
+    def analyze_position_steps(self, node: ChildNode, prev_score: Score, current_eval: PovScore, tier: int, board: Optional[Board] = None) -> Steps[Union[Puzzle, Score]]:
 
-    def analyze_position(self, node: ChildNode, prev_score: Score, current_eval: PovScore, tier: int) -> Union[Puzzle, Score]:
-
-        board = node.board()
+        if board is None:
+            board = node.board()
         winner = board.turn
         score = current_eval.pov(winner)
 
-        if board.legal_moves.count() < 2:
+        kind = self.probe_kind(node, board, prev_score, score, tier)
+        if kind is None:
             return score
+        with tracing.span("probe", kind = kind, ply = board.ply(), fen = board.fen()) as span:
+            if (yield blocking_call(self.server.is_seen_pos, board)):
+                logger.debug("Skip duplicate position")
+                span.set(seen = True)
+                return score
+            if kind == "mate":
+                mate_solution = yield from self.cook_mate_steps(board, winner, score.mate())
+                puzzle = self.mate_puzzle(node, mate_solution, tier)
+            else:
+                solution = yield from self.cook_advantage_steps(board, winner)
+                yield blocking_call(self.server.set_seen, node.game())
+                puzzle = self.advantage_puzzle(node, solution, tier)
+            span.set(puzzle = puzzle is not None)
+        return score if puzzle is None else puzzle
+
+    def probe_kind(self, node: ChildNode, board: Board, prev_score: Score, score: Score, tier: int) -> Optional[str]:
+        "whether the position should be probed for a mate or an advantage puzzle"
 
-        game_url = node.game().headers.get("Site")
+        if board.legal_moves.count() < 2:
+            return None
 
-        logger.debug("{} {} to {}".format(node.ply(), node.move.uci() if node.move else None, score))
+        logger.debug("{} {} to {}".format(board.ply(), node.move.uci() if node.move else None, score))
 
         if prev_score > Cp(300) and score < mate_soon:
-            logger.debug("{} Too much of a winning position to start with {} -> {}".format(node.ply(), prev_score, score))
-            return score
-        if is_up_in_material(board, winner):
-            logger.debug("{} already up in material {} {} {}".format(node.ply(), winner, material_count(board, winner), material_count(board, not winner)))
-            return score
+            logger.debug("{} Too much of a winning position to start with {} -> {}".format(board.ply(), prev_score, score))
+            return None
+        if is_up_in_material(board, board.turn):
+            logger.debug("{} already up in material {} {} {}".format(board.ply(), board.turn, material_count(board, board.turn), material_count(board, not board.turn)))
+            return None
         elif score >= Mate(1) and tier < 3:
-            logger.debug("{} mate in one".format(node.ply()))
-            return score
+            logger.debug("{} mate in one".format(board.ply()))
+            return None
         elif score > mate_soon:
-            logger.debug("Mate {}#{} Probing...".format(game_url, node.ply()))
-            if self.server.is_seen_pos(node):
-                logger.debug("Skip duplicate position")
-                return score
-            mate_solution = self.cook_mate(copy.deepcopy(node), winner)
-            if mate_solution is None or (tier == 1 and len(mate_solution) == 3):
-                return score
-            return Puzzle(node, mate_solution, 999999999)
-        elif score >= Cp(200) and win_chances(score) > win_chances(prev_score) + 0.6:
-            if score < Cp(400) and material_diff(board, winner) > -1:
+            logger.debug("Mate {}#{} Probing...".format(node.game().headers.get("Site"), board.ply()))
+            return "mate"
+        elif is_swing(prev_score, score):
+            if score < Cp(400) and material_diff(board, board.turn) > -1:
                 logger.debug("Not clearly winning and not from being down in material, aborting")
-                return score
-            logger.debug("Advantage {}#{} {} -> {}. Probing...".format(game_url, node.ply(), prev_score, score))
-            if self.server.is_seen_pos(node):
-                logger.debug("Skip duplicate position")
-                return score
-            puzzle_node = copy.deepcopy(node)
-            solution : Optional[List[NextMovePair]] = self.cook_advantage(puzzle_node, winner)
-            self.server.set_seen(node.game())
-            if not solution:
-                return score
-            while len(solution) % 2 == 0 or not solution[-1].second:
-                if not solution[-1].second:
-                    logger.debug("Remove final only-move")
-                solution = solution[:-1]
-            if not solution or len(solution) == 1 :
-                logger.debug("Discard one-mover")
-                return score
-            if tier < 3 and len(solution) == 3:
-                logger.debug("Discard two-mover")
-                return score
-            cp = solution[len(solution) - 1].best.score.score()
-            return Puzzle(node, [p.best.move for p in solution], 999999998 if cp is None else cp)
+                return None
+            logger.debug("Advantage {}#{} {} -> {}. Probing...".format(node.game().headers.get("Site"), board.ply(), prev_score, score))
+            return "advantage"
         else:
-            return score
+            return None
+
+    def mate_puzzle(self, node: ChildNode, mate_solution: Optional[List[Move]], tier: int) -> Optional[Puzzle]:
+        if mate_solution is None or (tier == 1 and len(mate_solution) == 3):
+            return None
+        return Puzzle(node, mate_solution, 999999999)
+
+    def advantage_puzzle(self, node: ChildNode, solution: Optional[List[NextMovePair]], tier: int) -> Optional[Puzzle]:
+        if not solution:
+            return None
+        while len(solution) % 2 == 0 or not solution[-1].second:
+            if not solution[-1].second:
+                logger.debug("Remove final only-move")
+            solution = solution[:-1]
+        if not solution or len(solution) == 1 :
+            logger.debug("Discard one-mover")
+            return None
+        if tier < 3 and len(solution) == 3:
+            logger.debug("Discard two-mover")
+            return None
+        cp = solution[len(solution) - 1].best.score.score()
+        return Puzzle(node, [p.best.move for p in solution], 999999998 if cp is None else cp)
+
+
+class Generator(BaseGenerator[CachedEngine]):
+    "`BaseGenerator` driving a `SimpleEngine`, one game at a time"
+
+    def __init__(self, engine: SimpleEngine, server: Server, cache_size: int = 10_000, store: Optional[EvalStore] = None, adaptive: bool = False, sweep_nodes: int = 0, profile: Optional[EngineProfile] = None, triage: float = 1, tablebase: Optional[Tablebase] = None):
+        super().__init__(CachedEngine(engine, cache_size, store), server, adaptive, sweep_nodes, profile, triage, tablebase)
+
+    def run(self, steps: Steps[T]) -> T:
+        "result of `steps`, making the calls they yield as they come"
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    if isinstance(call, EngineCall):
+                        result = getattr(self.engine, call.method)(*call.args, **call.kwargs)
+                    else:
+                        result = call.f(*call.args)
+                except Exception as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    def analyze_game(self, game: Game, tier: int) -> Optional[Puzzle]:
+        return self.run(self.analyze_game_steps(game, tier))
+
+    def analyze_position(self, node: ChildNode, prev_score: Score, current_eval: PovScore, tier: int, board: Optional[Board] = None) -> Union[Puzzle, Score]:
+        return self.run(self.analyze_position_steps(node, prev_score, current_eval, tier, board))
+
+    def get_next_pair(self, board: Board, winner: Color) -> Optional[NextMovePair]:
+        return self.run(self.get_next_pair_steps(board, winner))
+
+    def cook_mate(self, board: Board, winner: Color, mate: Optional[int] = None, reply: Optional[Move] = None) -> Optional[List[Move]]:
+        return self.run(self.cook_mate_steps(board, winner, mate, reply))
+
+    def cook_advantage(self, board: Board, winner: Color) -> Optional[List[NextMovePair]]:
+        return self.run(self.cook_advantage_steps(board, winner))
+
+
+class AsyncGenerator(BaseGenerator[AsyncCachedEngine]):
+    """
+    `BaseGenerator` driving an asyncio `UciProtocol`, so that several games can be analysed
+    concurrently against the same engine. Blocking calls run in the default executor.
+    """
+
+    def __init__(self, engine: UciProtocol, server: Server, cache_size: int = 10_000, store: Optional[EvalStore] = None, adaptive: bool = False, sweep_nodes: int = 0, profile: Optional[EngineProfile] = None, triage: float = 1, tablebase: Optional[Tablebase] = None):
+        super().__init__(AsyncCachedEngine(engine, cache_size, store), server, adaptive, sweep_nodes, profile, triage, tablebase)
+
+    async def in_executor(self, f: Callable[..., Any], *args: Any) -> Any:
+        # in the context of the task, so that server calls show in the trace of its game
+        return await asyncio.get_running_loop().run_in_executor(None, partial(copy_context().run, f, *args))
+
+    async def run(self, steps: Steps[T]) -> T:
+        "as `Generator.run`, awaiting the calls"
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    if isinstance(call, EngineCall):
+                        result = await getattr(self.engine, call.method)(*call.args, **call.kwargs)
+                    else:
+                        result = await self.in_executor(call.f, *call.args)
+                except Exception as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def analyze_game(self, game: Game, tier: int) -> Optional[Puzzle]:
+        return await self.run(self.analyze_game_steps(game, tier))
+
+
 
 
 def parse_args() -> argparse.Namespace:
@@ -239,101 +568,358 @@ def parse_args() -> argparse.Namespace:
         description='takes a pgn file and produces chess puzzles')
     parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
     parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
-    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches (default 4)", type=int)
+    add_engine_arguments(parser)
+    add_replay_arguments(parser)
+    add_tablebase_arguments(parser)
+    parser.add_argument("--workers", "-w", help="count of engine processes analysing games in parallel", default="1")
+    parser.add_argument("--asyncio", help="drive the engine with asyncio, overlapping searches with parsing and server calls", action="store_true")
+    parser.add_argument("--pipeline", help="with --asyncio, count of games in flight per engine", default="2")
+    parser.add_argument("--cache-size", help="count of engine results kept in memory", default="10000")
+    parser.add_argument("--store", help="sqlite file where engine results are kept across runs, shared with the tagger", metavar="FILE.sqlite")
+    parser.add_argument("--adaptive", help="stop searches for the only good move once the answer is clear and stable", action="store_true")
+    parser.add_argument("--sweep-nodes", help="node count of a first search over the moves without eval, only the ones around a swing get the full one. 0 to search them all fully", default="100000")
+    parser.add_argument("--triage", help="fraction of the moves without eval probed, the likeliest to start a tactic from static features, and the moves around them. 1 to probe them all, less trades puzzles for engine time, see bench_triage.py", default="1")
     parser.add_argument("--url", "-u", help="URL where to post puzzles", default="")
     parser.add_argument("--token", help="Server secret token", default="changeme")
+    parser.add_argument("--seen-cache-size", help="count of server answers about seen positions kept in memory", default="100000")
+    parser.add_argument("--prefetch-seen", help=f"load the positions of all known puzzles at startup, to ask the server only about likely duplicates for the first {BLOOM_TTL // 60} minutes", action="store_true")
+    parser.add_argument("--parse-all", help="parse every game, instead of skipping the analysed ones whose evals have no swing", action="store_true")
     parser.add_argument("--skip", help="How many games to skip from the source", default="0")
+    parser.add_argument("--resume", help="start after the last game done by the previous run on the same file, see NAME.checkpoint.json", action="store_true")
+    parser.add_argument("--stream", "-s", help="start analysing games while the headers are still being read", action="store_true")
+    parser.add_argument("--output-format", help="format of the output file when there is no --url", choices=FORMATS, default="csv")
+    parser.add_argument("--coordinator", help="instead of analysing the games, lease them to --worker generators from this HTTP address", metavar="HOST:PORT")
+    parser.add_argument("--range-size", help="with --coordinator, count of games per lease", default="1000")
+    parser.add_argument("--lease", help="with --coordinator, seconds after which the games of a silent worker go to another one", default="600")
+    parser.add_argument("--worker", help="analyse the games leased by the coordinator at this URL, in the same file at the same path", metavar="URL")
+    parser.add_argument("--metrics-port", help="serve Prometheus metrics at http://localhost:PORT/metrics")
+    parser.add_argument("--metrics-interval", help="seconds between metrics summaries in the logs, 0 for none", default="60")
+    parser.add_argument("--trace", help="append the steps of each game with their times to this file, see trace_report.py", metavar="FILE.jsonl")
     parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
     parser.add_argument("--players", nargs='+', help="A list of players. If set, only generate games in which one of them played")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.asyncio and (args.record or args.replay):
+        parser.error("--record and --replay don't work with --asyncio")
+    return args
 
 
-def make_engine(executable: str, threads: int) -> SimpleEngine:
+def make_engine(executable: str, profile: EngineProfile) -> SimpleEngine:
     engine = SimpleEngine.popen_uci(executable)
-    engine.configure({'Threads': threads})
+    profile.configure(engine)
     return engine
 
+def make_generator(args: argparse.Namespace, server: Server) -> Generator:
+    profile = profile_of(args, args.threads)
+    engine = open_engine(args, lambda: make_engine(args.engine, profile), logger)
+    return Generator(engine, server, int(args.cache_size), EvalStore(args.store) if args.store else None, args.adaptive, int(args.sweep_nodes), profile, float(args.triage), open_tablebase(args, logger))
 
-def open_file(file: str):
+
+def open_file(file: str, binary: bool = False):
     if file.endswith(".zst"):
-        return zstandard.open(file, "rt")
-    return open(file)
+        raw = io.BufferedReader(SeekableZstd(file, logger))
+        return raw if binary else io.TextIOWrapper(raw)
+    return open(file, "rb" if binary else "r")
+
+def filtered_offsets(pgn: BinaryIO, skip: int, players: Optional[List[str]]) -> Iterator[int]:
+    "offsets of the games of `pgn` matching the variant and players criterias"
+    games = 0
+    matching = 0
+    for offset, headers in scan_headers(pgn, ["Variant", "White", "Black"]):
+        if skip > 0:
+            skip -= 1
+            continue
+        games = games + 1
+        metrics.HEADERS.inc()
+        if games % 1000 == 0:
+            logger.info(f"{games} headers parsed")
+        variant = headers.get("Variant", "Standard")
+        black = headers.get("Black", "?")
+        white = headers.get("White", "?")
+        if variant != "Standard" and variant != "Chess960":
+            continue
+        if players is not None and black not in players and white not in players:
+            continue
+        matching += 1
+        yield offset
+    logger.info(f"All headers parsed, {matching}/{games} games that match the criterias.")
+
+def read_offsets(file: str, skip: int, players: Optional[List[str]], start: int = 0) -> Iterator[int]:
+    "see `filtered_offsets`, reading from the byte offset `start` of the (decompressed) file"
+    with open_file(file, binary=True) as pgn:
+        pgn.seek(start)
+        yield from filtered_offsets(pgn, skip, players)
+
+def read_game_at(pgn, i: int, game_offset: int) -> Game:
+    pgn.seek(game_offset)
+    game = chess.pgn.read_game(pgn)
+    assert(game)
+    black = game.headers.get("Black", "?")
+    white = game.headers.get("White", "?")
+    if game.errors:
+        logger.error(f"Illegal move detected in {white} vs {black}, game {i}")
+    return game
+
+def may_have_puzzle(pgn, game_offset: int) -> bool:
+    "False if the evals of the game at `game_offset` have no swing, read from its text before parsing it"
+    pgn.seek(game_offset)
+    scores = movetext_scores(pgn)
+    return scores is None or has_swing(scores)
+
+def log_puzzle(generator: BaseGenerator, file: str, game: Game, tier: int, i: int) -> None:
+    logger.info(f'v{version} {file} {metrics.knps()} knps, {generator.engine.stats()}, tier {tier}, game {i}')
+    print(f"Game: {game.headers.get('Site', '?')[20:]}")
+
+def analyze_games(args: argparse.Namespace, server: Server, tier: int, tasks, found: Callable[[Game, Puzzle], None], done: Callable[[int], None]) -> None:
+    "analyse the games of `tasks` until getting None, calling `found` for each puzzle and `done` after each game"
+    generator = make_generator(args, server)
+    writer = tracing.Writer(args.trace) if args.trace else None
+    try:
+        with open_file(args.file) as pgn:
+            for i, game_offset in iter(tasks.get, None):
+                if not args.parse_all:
+                    with metrics.STAGE_SECONDS.time("scan"):
+                        swing = may_have_puzzle(pgn, game_offset)
+                    if not swing:
+                        metrics.SKIPPED.inc()
+                        done(i)
+                        continue
+                with tracing.game(writer, i) as game_trace:
+                    with metrics.STAGE_SECONDS.time("read"), tracing.span("read"):
+                        game = read_game_at(pgn, i, game_offset)
+                    game_id = game.headers.get("Site", "?")[20:]
+                    game_trace.set(game = game_id)
+                    # logger.info(f'https://lichess.org/{game_id} tier {tier}')
+                    try:
+                        with metrics.STAGE_SECONDS.time("analyse"):
+                            puzzle = generator.analyze_game(game, tier)
+                        game_trace.set(puzzle = puzzle is not None)
+                        if puzzle is not None:
+                            log_puzzle(generator, args.file, game, tier, i)
+                            metrics.PUZZLES.inc()
+                            with metrics.STAGE_SECONDS.time("post"), tracing.span("post"):
+                                found(game, puzzle)
+                    except Exception as e:
+                        logger.error("Exception on {}: {}".format(game_id, e))
+                        game_trace.set(error = repr(e))
+                metrics.GAMES.inc()
+                done(i)
+    finally:
+        generator.engine.close()
+        if writer is not None:
+            writer.close()
+
+async def analyze_games_async(args: argparse.Namespace, server: Server, tier: int, tasks, found: Callable[[Game, Puzzle], None], done: Callable[[int], None]) -> None:
+    """
+    Same as `analyze_games`, with `--pipeline` games in flight sharing one engine:
+    while the engine searches for one of them, the others read their next game,
+    check seen positions and post puzzles.
+    """
+    profile = profile_of(args, args.threads)
+    if profile.clear_hash and int(args.pipeline) > 1:
+        logger.warning("Not clearing the engine hash between games, other games in flight still need it")
+        profile = replace(profile, clear_hash = False)
+    _, engine = await chess.engine.popen_uci(args.engine)
+    await engine.configure(profile.uci_options(engine))
+    generator = AsyncGenerator(engine, server, int(args.cache_size), EvalStore(args.store) if args.store else None, args.adaptive, int(args.sweep_nodes), profile, float(args.triage), open_tablebase(args, logger))
+    loop = asyncio.get_running_loop()
+    poster = ThreadPoolExecutor(max_workers = 1) # puzzles are still written one at a time
+    writer = tracing.Writer(args.trace) if args.trace else None
+
+    async def pipeline() -> None:
+        with open_file(args.file) as pgn:
+            while True:
+                task = await loop.run_in_executor(None, tasks.get)
+                if task is None:
+                    tasks.put(None) # so that the other pipelines stop too
+                    return
+                i, game_offset = task
+                if not args.parse_all:
+                    with metrics.STAGE_SECONDS.time("scan"):
+                        swing = await loop.run_in_executor(None, may_have_puzzle, pgn, game_offset)
+                    if not swing:
+                        metrics.SKIPPED.inc()
+                        await loop.run_in_executor(poster, done, i)
+                        continue
+                with tracing.game(writer, i) as game_trace:
+                    with metrics.STAGE_SECONDS.time("read"), tracing.span("read"):
+                        game = await loop.run_in_executor(None, read_game_at, pgn, i, game_offset)
+                    game_id = game.headers.get("Site", "?")[20:]
+                    game_trace.set(game = game_id)
+                    try:
+                        # includes waiting for the engine while it searches for other games
+                        with metrics.STAGE_SECONDS.time("analyse"):
+                            puzzle = await generator.analyze_game(game, tier)
+                        game_trace.set(puzzle = puzzle is not None)
+                        if puzzle is not None:
+                            log_puzzle(generator, args.file, game, tier, i)
+                            metrics.PUZZLES.inc()
+                            with metrics.STAGE_SECONDS.time("post"), tracing.span("post"):
+                                await loop.run_in_executor(poster, found, game, puzzle)
+                    except Exception as e:
+                        logger.error("Exception on {}: {}".format(game_id, e))
+                        game_trace.set(error = repr(e))
+                metrics.GAMES.inc()
+                await loop.run_in_executor(poster, done, i)
+
+    try:
+        await asyncio.gather(*[pipeline() for _ in range(int(args.pipeline))])
+    finally:
+        await generator.engine.quit()
+        poster.shutdown()
+        if writer is not None:
+            writer.close()
+
+def run(args: argparse.Namespace, server: Server, tier: int, tasks, found: Callable[[Game, Puzzle], None], done: Callable[[int], None]) -> None:
+    if args.asyncio:
+        asyncio.run(analyze_games_async(args, server, tier, tasks, found, done))
+    else:
+        analyze_games(args, server, tier, tasks, found, done)
+
+def worker(worker_id: int, args: argparse.Namespace, server: Server, tier: int, offsets: Queue, puzzles: Queue) -> None:
+    """
+    Owns its own engine and `Generator`, analyses the games at the offsets it is given
+    and sends the puzzles back to the main process, which is the only one writing them,
+    along with the index of each game done and a snapshot of its metrics.
+    `server` is a copy of the main process one, along with its prefetched positions.
+    """
+    metrics.REGISTRY.reset()
+
+    def found(game: Game, puzzle: Puzzle) -> None:
+        json = server.puzzle_json(game, puzzle)
+        server.posted(json) # the main process posts it, this one has to know too
+        puzzles.put(("puzzle", json))
+
+    try:
+        run(args, server, tier, offsets, found,
+            lambda i: puzzles.put(("done", i, worker_id, metrics.REGISTRY.snapshot())))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        puzzles.put(None)
 
 def main() -> None:
-    sys.setrecursionlimit(10000) # else node.deepcopy() sometimes fails?
     args = parse_args()
     if args.verbose >= 2:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-    engine = make_engine(args.engine, args.threads)
-    server = Server(logger, args.url, args.token, version)
-    generator = Generator(engine, server)
+    server = Server(logger, args.url, args.token, version, int(args.seen_cache_size))
+    if args.prefetch_seen:
+        server.prefetch_seen_positions()
     file = Path(args.file)
-    games = 0
-    site = "?"
-    has_master = False
     tier = 10
     skip = int(args.skip)
-    write_h = skip > 0 # Erase the .csv file if not skipping any game (i.e starting over), else add
-    logger.info("Skipping first {} games".format(skip))
+    workers = int(args.workers)
+    players = args.players
+    name = "_".join(players) if players is not None else file.stem
+    previous = Checkpoint.load(f"{name}.checkpoint.json", args.file) if args.resume else None
+    start = 0
+    if previous is not None:
+        # the game at `offset` is done, skip it and start from there
+        start, skip = previous["offset"], 1
+        logger.info(f"Resuming after {previous['games']} games and {previous['puzzles']} puzzles, at byte {start}")
+    elif args.resume:
+        logger.info("No checkpoint to resume from, starting over")
+    else:
+        logger.info("Skipping first {} games".format(skip))
 
     print(f'v{version}')
-    players = args.players
+    if args.metrics_port:
+        metrics.serve(int(args.metrics_port))
+    if float(args.metrics_interval) > 0:
+        metrics.log_summary(logger, float(args.metrics_interval))
+    if args.file.endswith(".zst"):
+        load_index(args.file, logger) # once, before several processes read the file
+    if args.coordinator:
+        host, port = args.coordinator.rsplit(":", 1)
+        coordinator = Coordinator(args.file, list(read_offsets(args.file, skip, players, start)), logger, int(args.range_size), float(args.lease))
+        coordinator.serve(host, int(port))
+        return
+    # where the games come from, and where their progress goes
+    progress: Union[Checkpoint, RemoteRanges] = (
+        RemoteRanges(args.worker, args.file, f"{socket.gethostname()}:{os.getpid()}", logger, metrics.knps)
+        if args.worker else Checkpoint(f"{name}.checkpoint.json", args.file, logger, previous)
+    )
+
+    dispatched = None
+    dispatch_error: Optional[BaseException] = None
+    failed: List[int] = []
+    def dispatch(offsets: Iterable[int], tasks, sentinels: int) -> None:
+        "the analysers stop on their sentinel even when reading the offsets fails, which main then reports"
+        nonlocal dispatched, dispatch_error
+        try:
+            for task in enumerate(offsets):
+                progress.dispatched(*task)
+                tasks.put(task)
+                dispatched = task[0]
+        except BaseException as e:
+            dispatch_error = e
+        finally:
+            for _ in range(sentinels):
+                tasks.put(None)
+
+    # puzzles are posted in the background, unsent ones are replayed from the spool on restart
+    server.open_outbox(f"{name}.spool.jsonl")
+    server.open_sink(name, args.output_format, append = skip > 0 or previous is not None)
+
+    def post(game: Game, puzzle: Puzzle) -> None:
+        server.post(game, puzzle)
+        progress.found()
 
     try:
-        i = None
-        with open_file(args.file) as pgn:
-            filtered_games_offset: List[int] = []
-            while "Look for all headers of the file":
-                offset = pgn.tell()
-                headers = chess.pgn.read_headers(pgn)
-                if skip > 0:
-                    skip -= 1
-                    continue
-                if headers is None:
-                    break
-                games = games + 1
-                if games % 1000 == 0:
-                    logger.info(f"{games} headers parsed")
-                variant = headers.get("Variant", "Standard")
-                black = headers.get("Black", "?")
-                white = headers.get("White", "?")
-                white_title = headers.get("WhiteTitle", "?")
-                black_title = headers.get("BlackTitle", "?")
-                if variant != "Standard" and variant != "Chess960":
-                    continue
-                if players is not None and black not in players and white not in players:
-                    continue
-                filtered_games_offset.append(offset)
-            logger.info(f"All headers parsed, {len(filtered_games_offset)}/{games} games that match the criterias.")
-
-            for i, game_offset in enumerate(filtered_games_offset):
-                pgn.seek(game_offset)
-                game = chess.pgn.read_game(pgn)
-                black = game.headers.get("Black", "?")
-                white = game.headers.get("White", "?")
-                if game.errors:
-                    logger.error(f"Illegal move detected in {white} vs {black}, game {i}")
-                assert(game)
-                game_id = game.headers.get("Site", "?")[20:]
-                # logger.info(f'https://lichess.org/{game_id} tier {tier}')
-                try:
-                    puzzle = generator.analyze_game(game, tier)
-                    if puzzle is not None:
-                        logger.info(f'v{version} {args.file} {util.avg_knps()} knps, tier {tier}, game {i}')
-                        print(f"Game: {game_id}")
-                        server.post(game, puzzle, "_".join(players) if players is not None else file.stem, write_h)
-                        write_h = False
-                except Exception as e:
-                    logger.error("Exception on {}: {}".format(game_id, e))
+        if isinstance(progress, RemoteRanges):
+            offsets: Iterable[int] = progress
+        elif args.stream:
+            # headers are read in the background, games are analysed as soon as they match
+            offsets = read_offsets(args.file, skip, players, start)
+        else:
+            offsets = list(read_offsets(args.file, skip, players, start))
+
+        if workers > 1:
+            logger.info(f"{workers} engines with {profile_of(args, args.threads).hash} MiB of hash each")
+            tasks: Queue = Queue(queue_size)
+            puzzles: Queue = Queue()
+            processes = [Process(target=worker, args=(w, args, server, tier, tasks, puzzles)) for w in range(workers)]
+            for process in processes:
+                process.start()
+            Thread(target=dispatch, args=(offsets, tasks, workers), daemon=True).start()
+            running = workers
+            while running:
+                message = puzzles.get()
+                if message is None:
+                    running -= 1
+                elif message[0] == "puzzle":
+                    server.post_json(message[1])
+                    progress.found()
+                else:
+                    _, i, worker_id, snapshot = message
+                    metrics.REGISTRY.absorb(worker_id, snapshot)
+                    progress.finished(i)
+            for process in processes:
+                process.join()
+            # a worker which crashed still sent its None, its games in progress are left undone
+            failed = [w for w, process in enumerate(processes) if process.exitcode != 0]
+        else:
+            local_tasks: queue.Queue = queue.Queue(queue_size)
+            Thread(target=dispatch, args=(offsets, local_tasks, 1), daemon=True).start()
+            run(args, server, tier, local_tasks, post, progress.finished)
     except KeyboardInterrupt:
-        print(f'v{version} {args.file} Game {i}')
+        print(f'v{version} {args.file} Game {dispatched}')
+        progress.write()
+        server.close()
         sys.exit(1)
 
-    engine.close()
-    print(f'v{version} {args.file} Game {i}')
+    progress.write()
+    server.close()
+    print(f'v{version} {args.file} Game {dispatched}')
+    if failed:
+        logger.error(f"Workers {failed} failed, the games they were analysing aren't done")
+    if dispatch_error is not None:
+        logger.error("Stopped reading games", exc_info = dispatch_error)
+    if failed or dispatch_error is not None:
+        sys.exit(1)
 
 if __name__ == "__main__":
     print('#'*80)
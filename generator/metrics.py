@@ -0,0 +1,211 @@
+import logging
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Any, Dict, List, Tuple
+
+# label values of a sample, in the order of the metric's label names
+Labels = Tuple[str, ...]
+
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Labels, float] = {}
+        self.lock = Lock()
+
+    def inc(self, value: float = 1, *labels: str) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def snapshot(self) -> Dict[Labels, Any]:
+        with self.lock:
+            return dict(self.values)
+
+    @staticmethod
+    def merge(a: Any, b: Any) -> Any:
+        return a + b
+
+    def lines(self, values: Dict[Labels, Any]) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels, labels)} {value}" for labels, value in sorted(values.items())]
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: List[float] = SECONDS_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> (count per bucket, the last one being +Inf, sum)
+        self.values: Dict[Labels, Tuple[List[int], float]] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self.lock:
+            counts, total = self.values.get(labels) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def time(self, *labels: str) -> "Timer":
+        return Timer(self, labels)
+
+    def snapshot(self) -> Dict[Labels, Any]:
+        with self.lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+
+    @staticmethod
+    def merge(a: Any, b: Any) -> Any:
+        return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1]
+
+    def lines(self, values: Dict[Labels, Any]) -> List[str]:
+        lines = []
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for le, count in zip([str(b) for b in self.buckets] + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Timer:
+    "context manager observing the seconds spent in it"
+
+    def __init__(self, histogram: Histogram, labels: Labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "Timer":
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.histogram.observe(time.monotonic() - self.start, *self.labels)
+
+
+def format_labels(names: Tuple[str, ...], values: Labels) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Registry:
+    """
+    Metrics of this process, and the last snapshots of the ones of worker processes,
+    which are added to them when exported.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Any] = {}
+        self.remote: Dict[Any, Dict[str, Dict[Labels, Any]]] = {}
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: List[float] = SECONDS_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+    def snapshot(self) -> Dict[str, Dict[Labels, Any]]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def reset(self) -> None:
+        "start from zero, in a worker process forked with the counts of its parent"
+        for metric in self.metrics.values():
+            with metric.lock:
+                metric.values = {}
+        self.remote = {}
+
+    def absorb(self, source: Any, snapshot: Dict[str, Dict[Labels, Any]]) -> None:
+        "keep the snapshot of another process, replacing its previous one"
+        self.remote[source] = snapshot
+
+    def merged(self) -> Dict[str, Dict[Labels, Any]]:
+        merged = self.snapshot()
+        for snapshot in list(self.remote.values()):
+            for name, values in snapshot.items():
+                metric = self.metrics[name]
+                for labels, value in values.items():
+                    mine = merged[name].get(labels)
+                    merged[name][labels] = value if mine is None else metric.merge(mine, value)
+        return merged
+
+    def render(self) -> str:
+        "Prometheus text exposition format"
+        merged = self.merged()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {'counter' if isinstance(metric, Counter) else 'histogram'}")
+            lines.extend(metric.lines(merged[name]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HEADERS = REGISTRY.counter("generator_headers_parsed_total", "game headers parsed")
+GAMES = REGISTRY.counter("generator_games_analysed_total", "games analysed")
+SKIPPED = REGISTRY.counter("generator_games_skipped_total", "analysed games skipped before parsing, their evals having no swing")
+PUZZLES = REGISTRY.counter("generator_puzzles_total", "puzzles found")
+ENGINE_CALLS = REGISTRY.counter("generator_engine_calls_total", "searches by kind, not counting the ones answered by the cache or store", ("kind",))
+ENGINE_CACHED = REGISTRY.counter("generator_engine_cached_total", "searches answered by the cache or store", ("kind",))
+ENGINE_NODES = REGISTRY.counter("generator_engine_nodes_total", "nodes searched, as reported by the engine", ("kind",))
+TABLEBASE = REGISTRY.counter("generator_tablebase_probes_total", "searches answered by the tablebases instead of the engine", ("kind",))
+ENGINE_SECONDS = REGISTRY.histogram("generator_engine_seconds", "time of each search", ("kind",))
+STAGE_SECONDS = REGISTRY.histogram("generator_stage_seconds", "time of each stage of a game", ("stage",))
+SEEN_SECONDS = REGISTRY.histogram("generator_seen_check_seconds", "time of each request to the validator about seen games or positions", ("kind",))
+
+def knps() -> int:
+    "average thousands of nodes per second of the searches that reported their nodes"
+    merged = REGISTRY.merged()
+    nodes = sum(merged[ENGINE_NODES.name].values())
+    seconds = sum(total for labels, (_, total) in merged[ENGINE_SECONDS.name].items() if labels in merged[ENGINE_NODES.name])
+    return round(nodes / seconds / 1000) if seconds else 0
+
+def summary() -> str:
+    merged = REGISTRY.merged()
+    def total(metric: Counter) -> int:
+        return int(sum(merged[metric.name].values()))
+    def mean(metric: Histogram, labels: Labels) -> float:
+        counts, seconds = merged[metric.name][labels]
+        return seconds / max(sum(counts), 1)
+    calls = ", ".join(f"{kind} {int(n)}" for (kind,), n in sorted(merged[ENGINE_CALLS.name].items()))
+    stages = ", ".join(f"{stage} {mean(STAGE_SECONDS, (stage,)):.2f}s" for (stage,) in sorted(merged[STAGE_SECONDS.name]))
+    return (
+        f"{total(HEADERS)} headers, {total(GAMES)} games ({total(SKIPPED)} more skipped), {total(PUZZLES)} puzzles, {knps()} knps, "
+        f"searches: {calls or 'none'} ({total(ENGINE_CACHED)} cached), mean per game: {stages or 'none'}"
+    )
+
+def log_summary(logger: logging.Logger, interval: float) -> None:
+    "log `summary()` every `interval` seconds, in the background"
+    def loop() -> None:
+        while True:
+            time.sleep(interval)
+            logger.info(f"Metrics: {summary()}")
+    Thread(target = loop, daemon = True).start()
+
+def serve(port: int) -> None:
+    "export the metrics at http://localhost:`port`/metrics, in the background"
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                return self.send_error(404)
+            data = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    Thread(target = server.serve_forever, daemon = True).start()
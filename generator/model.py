@@ -1,5 +1,5 @@
 from chess.pgn import GameNode, ChildNode
-from chess import Move, Color
+from chess import Board, Move, Color
 from chess.engine import Score
 from dataclasses import dataclass
 from typing import Tuple, List, Optional
@@ -23,7 +23,7 @@ class EngineMove:
 
 @dataclass
 class NextMovePair:
-    node: GameNode
+    board: Board # the line being cooked, only meaningful until its next push
     winner: Color
     best: EngineMove
     second: Optional[EngineMove]
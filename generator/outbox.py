@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import queue
+import time
+from threading import Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 5 # seconds a puzzle can wait for its batch to fill up
+RETRY_MAX_DELAY = 60
+
+Json = Dict[str, Any]
+
+class Outbox:
+    """
+    Puzzles waiting to be sent, posted in batches from a background thread so that analysis
+    never waits on the validator. Every puzzle is appended to `spool` before being queued,
+    and `spool.acked` records how far the spool was sent: what lies beyond it is sent again
+    on the next start. A puzzle sent right before a crash can be sent twice, the validator
+    rejecting the second one as a duplicate game.
+    """
+
+    def __init__(self, logger: logging.Logger, send: Callable[[List[Json]], None], spool: str, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.logger = logger
+        self.send = send
+        self.spool = spool
+        self.acked_path = f"{spool}.acked"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # (puzzle, spool offset right after it)
+        self.queue: "queue.Queue[Optional[Tuple[Json, int]]]" = queue.Queue()
+        self.acked = self.read_acked()
+        self.spool_h = open(spool, "ab")
+        self.replay()
+        self.thread = Thread(target = self.loop, daemon = True)
+        self.thread.start()
+
+    def read_acked(self) -> int:
+        try:
+            with open(self.acked_path) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_acked(self, offset: int) -> None:
+        tmp = f"{self.acked_path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, self.acked_path)
+        self.acked = offset
+
+    def replay(self) -> None:
+        "queue again the puzzles spooled by a previous run and never sent"
+        nb = 0
+        with open(self.spool, "rb") as f:
+            f.seek(self.acked)
+            for line in f:
+                if not line.endswith(b"\n"): # torn by a crash while being written
+                    break
+                self.queue.put((json.loads(line), f.tell()))
+                nb += 1
+        if nb:
+            self.logger.info(f"Replaying {nb} unsent puzzles from {self.spool}")
+
+    def put(self, puzzle: Json) -> None:
+        self.spool_h.write(json.dumps(puzzle).encode() + b"\n")
+        self.spool_h.flush()
+        self.queue.put((puzzle, self.spool_h.tell()))
+
+    def next_batch(self) -> Tuple[List[Json], int, bool]:
+        "puzzles of the next batch, spool offset after the last of them, and whether the outbox is closed"
+        batch: List[Json] = []
+        offset = self.acked
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                item = self.queue.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, offset, True
+            puzzle, offset = item
+            batch.append(puzzle)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch, offset, False
+
+    def loop(self) -> None:
+        closed = False
+        while not closed:
+            batch, offset, closed = self.next_batch()
+            delay = 1
+            while batch:
+                try:
+                    self.send(batch)
+                    self.write_acked(offset)
+                    break
+                except Exception as e:
+                    self.logger.error(f"Couldn't post {len(batch)} puzzles, retrying in {delay}s: {e}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, RETRY_MAX_DELAY)
+        if not self.spool_h.closed and self.acked == self.spool_h.tell():
+            # all sent, start the next run with an empty spool
+            self.spool_h.truncate(0)
+            self.write_acked(0)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        "send what is queued, waiting at most `timeout` seconds. What is left stays in the spool"
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.logger.warning(f"Validator unreachable, unsent puzzles are kept in {self.spool}")
+        self.spool_h.close()
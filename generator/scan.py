@@ -0,0 +1,106 @@
+import re
+from chess.engine import Score, Cp, Mate
+from chess.pgn import EVAL_REGEX
+from typing import BinaryIO, Collection, Dict, Iterator, List, Optional, TextIO, Tuple
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+TAG_LINE = rb'\[[A-Za-z0-9_]+\s+"[^\n]*\n'
+# a run of tag pair lines, i.e the headers of one game. `[%clk ...]` and friends
+# at the start of a wrapped movetext line can't match since they start with `%`
+HEADERS_REGEX = re.compile(rb'^(?:' + TAG_LINE + rb')+', re.M)
+# same tag pairs as chess.pgn.TAG_REGEX
+TAG_REGEX = re.compile(rb'^\[([A-Za-z0-9_]+)\s+"([^\r\n]*)"\]\s*$', re.M)
+
+# tokens of a movetext: a comment, the start or end of a variation, a rest of line comment,
+# a NAG, a result, a move number or else a move
+MOVETEXT_TOKEN = re.compile(r'\{([^}]*)\}|([()])|;[^\n]*|\$\d+|(?:1-0|0-1|1/2-1/2|\*)|\d+\.+|([^\s{}();$]+)')
+
+def last_blank_line(buf: bytes) -> int:
+    "index right after the last blank line of `buf`, -1 if there is none"
+    lf = buf.rfind(b"\n\n")
+    crlf = buf.rfind(b"\n\r\n")
+    if lf == -1 and crlf == -1:
+        return -1
+    return max(lf + 2, crlf + 3)
+
+def scan_headers(fh: BinaryIO, tags: Optional[Collection[str]] = None, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """
+    Offset and tag pairs of every game of `fh`, only looking at raw bytes.
+    If `tags` is set, only those tag pairs are decoded.
+    """
+    wanted = None if tags is None else {tag.encode() for tag in tags}
+    base = fh.tell()
+    rest = b""
+    while True:
+        chunk = fh.read(chunk_size)
+        buf = rest + chunk
+        end = last_blank_line(buf) if chunk else len(buf)
+        if end == -1: # no game ends in this chunk
+            rest = buf
+            continue
+        for match in HEADERS_REGEX.finditer(buf, 0, end):
+            headers = {}
+            for name, value in TAG_REGEX.findall(match.group()):
+                if wanted is None or name in wanted:
+                    headers[name.decode()] = value.decode("utf-8", "replace")
+            yield base + match.start(), headers
+        base += end
+        rest = buf[end:]
+        if not chunk:
+            break
+
+def read_movetext(pgn: TextIO) -> Optional[str]:
+    "movetext of the game `pgn` is at, None if it doesn't start from the initial position"
+    lines: List[str] = []
+    while True:
+        line = pgn.readline()
+        if not line:
+            break
+        if line.startswith("["):
+            if lines: # next game
+                break
+            if line.startswith("[FEN "):
+                return None
+        elif line.strip():
+            lines.append(line)
+        elif lines:
+            break
+    return "".join(lines)
+
+def movetext_scores(pgn: TextIO) -> Optional[List[Score]]:
+    """
+    Score after each mainline move of the game `pgn` is at, from the point of view of the
+    side to move as with `util.node_eval`, read from the `[%eval]` comments of the raw text
+    without parsing moves. None if some can't be told this way: a move without eval, as soon
+    as the next move shows it, or a game from a position.
+    """
+    movetext = read_movetext(pgn)
+    if movetext is None:
+        return None
+    scores: List[Optional[Score]] = []
+    depth = 0 # of variations
+    for match in MOVETEXT_TOKEN.finditer(movetext):
+        comment, variation, move = match.groups()
+        if variation:
+            depth += 1 if variation == "(" else -1
+        elif depth:
+            continue
+        elif move:
+            if scores and scores[-1] is None:
+                return None # not analysed, no need to read further
+            # a checkmate has no eval, the side to move is mated
+            scores.append(Mate(0) if move.endswith("#") else None)
+        elif comment and scores and scores[-1] in (None, Mate(0)):
+            found = EVAL_REGEX.search(comment)
+            if found:
+                white_to_move = len(scores) % 2 == 0
+                if found.group(1):
+                    mate = int(found.group(1))
+                    score: Score = Mate(mate)
+                else:
+                    score = Cp(int(float(found.group(2)) * 100))
+                scores[-1] = score if white_to_move or score == Mate(0) else -score
+    if scores and scores[-1] is None:
+        return None
+    return [score for score in scores if score is not None] # all of them by now
@@ -1,9 +1,18 @@
 import logging
-import csv
+import time
+from threading import Lock
+from bloom import BloomFilter
+from chess import Board
 from chess.pgn import Game, GameNode, ChildNode
+from metrics import SEEN_SECONDS
+import tracing
 from model import Puzzle
+from outbox import Outbox
+from sink import Sink, make_sink
 import requests
 import urllib.parse
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
@@ -17,52 +26,205 @@ adapter = HTTPAdapter(max_retries=retry_strategy)
 http = requests.Session()
 http.mount("https://", adapter)
 http.mount("http://", adapter)
+# the outbox retries failed batches on its own, without holding them in a request forever
+outbox_adapter = HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=0.1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    method_whitelist=["POST"]
+))
+outbox_http = requests.Session()
+outbox_http.mount("https://", outbox_adapter)
+outbox_http.mount("http://", outbox_adapter)
 
 TIMEOUT = 5
+BLOOM_CAPACITY = 5_000_000
+UNSEEN_TTL = 60 # seconds a "not seen" answer is trusted, other processes may post the position meanwhile
+BLOOM_TTL = 600 # seconds the bloom filter is trusted about unseen positions, for the same reason
 
 class Server:
 
-    def __init__(self, logger: logging.Logger, url: str, token: str, version: str) -> None:
+    def __init__(self, logger: logging.Logger, url: str, token: str, version: str, seen_cache_size: int = 100_000) -> None:
         self.logger = logger
         self.url = url
         self.token = token
         self.version = version
+        # answers of the validator and when they came, most recently used last
+        self.seen_cache_size = seen_cache_size
+        self.seen: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        # positions known to the validator at startup, see `prefetch_seen_positions`
+        self.bloom: Optional[BloomFilter] = None
+        self.bloom_expires = 0.0
+        # `seen` and `bloom` are updated from executor threads with --asyncio
+        self.lock = Lock()
+        self.outbox: Optional[Outbox] = None
+        self.sink: Optional[Sink] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # worker processes get a copy without the outbox, only the main process posts
+        state = dict(self.__dict__)
+        state["outbox"] = None
+        state["sink"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def open_outbox(self, spool: str) -> None:
+        "post puzzles in the background from now on, see `Outbox`"
+        if self.url:
+            self.outbox = Outbox(self.logger, self.post_batch, spool)
+
+    def open_sink(self, name: str, format: str, append: bool) -> None:
+        "where puzzles are written when there is no url to post them to"
+        if not self.url:
+            self.sink = make_sink(name, format, append)
+
+    def close(self) -> None:
+        if self.outbox is not None:
+            self.outbox.close(TIMEOUT * 6)
+            self.outbox = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def cached_seen(self, id: str) -> Optional[bool]:
+        "answer about `id` still valid: seen ones stay seen, unseen ones are asked again after `UNSEEN_TTL`"
+        with self.lock:
+            cached = self.seen.get(id)
+            if cached is None:
+                return None
+            seen, at = cached
+            if not seen and time.monotonic() - at > UNSEEN_TTL:
+                del self.seen[id]
+                return None
+            self.seen.move_to_end(id)
+            return seen
+
+    def cache_seen(self, id: str, seen: bool) -> None:
+        if self.seen_cache_size <= 0:
+            return
+        with self.lock:
+            self.seen[id] = (seen, time.monotonic())
+            self.seen.move_to_end(id)
+            if len(self.seen) > self.seen_cache_size:
+                self.seen.popitem(last = False)
+
+    def use_bloom(self, bloom: BloomFilter) -> None:
+        "take positions not in `bloom` for unseen without asking, for the next `BLOOM_TTL` seconds"
+        self.bloom = bloom
+        self.bloom_expires = time.monotonic() + BLOOM_TTL
+
+    def trusted_bloom(self) -> Optional[BloomFilter]:
+        "the bloom filter while its misses can be trusted, positions posted since by other processes aren't in it"
+        with self.lock:
+            if self.bloom is not None and time.monotonic() > self.bloom_expires:
+                self.logger.info("Bloom filter of seen positions expired, asking the validator about all of them")
+                self.bloom = None
+            return self.bloom
 
     def is_seen(self, id: str) -> bool:
         if not self.url:
             return False
+        seen = self.cached_seen(id)
+        if seen is not None:
+            return seen
         try:
-            status = http.get(self._seen_url(id), timeout = TIMEOUT).status_code
-            return status == 200
+            with SEEN_SECONDS.time("get"), tracing.span("server", call = "is_seen", id = id):
+                seen = http.get(self._seen_url(urllib.parse.quote(id)), timeout = TIMEOUT).status_code == 200
+            self.cache_seen(id, seen)
+            return seen
         except Exception as e:
             self.logger.error(e)
             return False
 
     def set_seen(self, game: Game) -> None:
+        id = game.headers.get("Site", "?")[20:]
+        if not self.url or self.cached_seen(id):
+            return
         try:
-            if self.url:
-                http.post(self._seen_url(game.headers.get("Site", "?")[20:]), timeout = TIMEOUT)
+            with SEEN_SECONDS.time("set"), tracing.span("server", call = "set_seen", id = id):
+                http.post(self._seen_url(id), timeout = TIMEOUT)
+            self.cache_seen(id, True)
         except Exception as e:
             self.logger.error(e)
 
-    def is_seen_pos(self, node: ChildNode) -> bool:
+    def position_id(self, board: Board) -> str:
+        "id of the position before the last move of `board`, and of that move"
+        parent = board.copy(stack = 1)
+        move = parent.pop()
+        return f"{parent.fen()}:{parent.uci(move)}"
+
+    def is_seen_pos(self, board: Board) -> bool:
         if not self.url:
             return False
-        id = urllib.parse.quote(f"{node.parent.board().fen()}:{node.uci()}")
+        id = self.position_id(board)
+        bloom = self.trusted_bloom()
+        if bloom is not None and id not in bloom and self.cached_seen(id) is None:
+            return False
+        return self.is_seen(id)
+
+    def are_seen(self, ids: List[str]) -> None:
+        """
+        Ask the validator about all of `ids` in a single request, so that the following
+        `is_seen` and `is_seen_pos` calls about them are answered locally.
+        """
+        bloom = self.trusted_bloom()
+        ids = [id for id in dict.fromkeys(ids) if self.cached_seen(id) is None and (
+            bloom is None or len(id) == 8 or id in bloom
+        )]
+        if not self.url or not ids:
+            return
         try:
-            status = http.get(self._seen_url(id), timeout = TIMEOUT).status_code
-            return status == 200
+            with SEEN_SECONDS.time("batch"), tracing.span("server", call = "are_seen", ids = len(ids)):
+                r = http.post("{}/seen/batch?token={}".format(self.url, self.token), json = {"ids": ids}, timeout = TIMEOUT)
+            r.raise_for_status()
+            seen = set(r.json()["seen"])
+            for id in ids:
+                self.cache_seen(id, id in seen)
         except Exception as e:
             self.logger.error(e)
-            return False
+
+    def prefetch_seen_positions(self, capacity: int = BLOOM_CAPACITY) -> None:
+        """
+        Load the positions of all known puzzles into a bloom filter, so that positions not
+        in it are known unseen without asking. Puzzles posted by other generators or worker
+        processes after this point aren't in it, and the validator only rejects duplicate
+        games, not positions: misses are trusted for `BLOOM_TTL` seconds only, then the
+        validator is asked again about every position.
+        """
+        if not self.url:
+            return
+        self.logger.info("Prefetching seen positions...")
+        bloom = BloomFilter(capacity)
+        nb = 0
+        try:
+            with http.get("{}/seen/positions?token={}".format(self.url, self.token), stream = True, timeout = TIMEOUT) as r:
+                r.raise_for_status()
+                for line in r.iter_lines(decode_unicode = True):
+                    if line:
+                        bloom.add(line)
+                        nb += 1
+        except Exception as e:
+            self.logger.error(f"Couldn't prefetch seen positions: {e}")
+            return
+        if nb > capacity:
+            self.logger.warning(f"{nb} seen positions for a bloom filter of {capacity}, expect more lookups")
+        self.logger.info(f"{nb} seen positions prefetched")
+        self.use_bloom(bloom)
 
     def _seen_url(self, id: str) -> str:
         return "{}/seen?token={}&id={}".format(self.url, self.token, id)
 
-    def post(self, game: Game, puzzle: Puzzle, name: str, write_h: bool = False) -> None:
+    def post(self, game: Game, puzzle: Puzzle) -> None:
+        self.post_json(self.puzzle_json(game, puzzle))
+
+    def puzzle_json(self, game: Game, puzzle: Puzzle) -> Dict[str, Any]:
         parent = puzzle.node.parent
         assert parent
-        json = {
+        return {
             'white': game.headers.get("White", "?"),
             'black': game.headers.get("Black", "?"),
             'game_id': game.headers.get("Site", "?")[20:],
@@ -72,16 +234,34 @@ class Server:
             'cp': puzzle.cp,
             'generator_version': self.version,
         }
+
+    def posted(self, json: Dict[str, Any]) -> None:
+        "remember the position of a puzzle about to be posted as seen, so that no other game makes it again"
+        id = f"{json['fen']}:{json['moves'][0]}"
+        self.cache_seen(id, True)
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(id)
+
+    def post_json(self, json: Dict[str, Any]) -> None:
+        self.posted(json)
         if not self.url:
-            print(json)
-            with open(f"{name}.csv", "w" if write_h else "a") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=json.keys())
-                if write_h:
-                    writer.writeheader()
-                writer.writerow(json)
+            self.logger.debug(json)
+            if self.sink is not None:
+                self.sink.write(json)
+            return None
+        if self.outbox is not None:
+            self.outbox.put(json)
             return None
         try:
             r = http.post("{}/puzzle?token={}".format(self.url, self.token), json=json)
             self.logger.info(r.text if r.ok else "FAILURE {}".format(r.text))
         except Exception as e:
             self.logger.error("Couldn't post puzzle: {}".format(e))
+
+    def post_batch(self, puzzles: List[Dict[str, Any]]) -> None:
+        "raises if the batch wasn't received, so that the outbox sends it again"
+        r = outbox_http.post("{}/puzzle/batch?token={}".format(self.url, self.token), json={"puzzles": puzzles}, timeout = TIMEOUT * 6)
+        r.raise_for_status()
+        for text in r.json():
+            self.logger.info(text)
@@ -0,0 +1,157 @@
+import abc
+import csv
+import gzip
+import io
+import json
+import time
+import zstandard
+from typing import Any, Dict, List, Optional
+
+FLUSH_INTERVAL = 10 # seconds between flushes to disk
+PARQUET_ROW_GROUP = 10_000
+
+FORMATS = ["csv", "jsonl.gz", "jsonl.zst", "parquet"]
+
+Json = Dict[str, Any]
+
+class Sink(abc.ABC):
+    """
+    Where puzzles go when there is no server to post them to. The file is kept open
+    and written through a buffer, flushed every `FLUSH_INTERVAL` seconds and on close.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.last_flush = time.monotonic()
+
+    def write(self, puzzle: Json) -> None:
+        self.write_puzzle(puzzle)
+        if time.monotonic() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    @abc.abstractmethod
+    def write_puzzle(self, puzzle: Json) -> None:
+        ...
+
+    def flush(self) -> None:
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+
+
+class CsvSink(Sink):
+
+    def __init__(self, path: str, append: bool) -> None:
+        super().__init__(path)
+        self.file = open(path, "a" if append else "w", newline = "")
+        # a file appended to already has its header
+        self.header = not append or self.file.tell() == 0
+        self.writer: Optional[csv.DictWriter] = None
+
+    def write_puzzle(self, puzzle: Json) -> None:
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames = puzzle.keys())
+            if self.header:
+                self.writer.writeheader()
+        self.writer.writerow(puzzle)
+
+    def flush(self) -> None:
+        self.file.flush()
+        super().flush()
+
+    def close(self) -> None:
+        super().close()
+        self.file.close()
+
+
+class JsonlSink(Sink):
+    "one json object per line, gzip or zstd compressed. Appending adds a new gzip member or zstd frame"
+
+    def __init__(self, path: str, append: bool) -> None:
+        super().__init__(path)
+        self.raw = open(path, "ab" if append else "wb")
+        self.text: io.TextIOWrapper
+        if path.endswith(".zst"):
+            zstd = zstandard.ZstdCompressor().stream_writer(self.raw, closefd = False)
+            self.text = io.TextIOWrapper(zstd, encoding = "utf-8", write_through = False)
+        else:
+            gz = gzip.GzipFile(fileobj = self.raw, mode = "ab")
+            self.text = io.TextIOWrapper(gz, encoding = "utf-8", write_through = False)
+
+    def write_puzzle(self, puzzle: Json) -> None:
+        self.text.write(json.dumps(puzzle))
+        self.text.write("\n")
+
+    def flush(self) -> None:
+        self.text.flush() # the compressor flushes a complete block, readable up to there
+        self.raw.flush()
+        super().flush()
+
+    def close(self) -> None:
+        super().close()
+        self.text.close() # ends the gzip member / zstd frame
+        self.raw.close()
+
+
+class ParquetSink(Sink):
+    """
+    Rows are buffered and written as row groups of `PARQUET_ROW_GROUP` rows, the last one
+    on close. Periodic flushes leave them buffered, as small row groups load slowly. Needs `pyarrow`.
+    """
+
+    def __init__(self, path: str, append: bool) -> None:
+        super().__init__(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow, `pip install pyarrow`")
+        if append:
+            raise RuntimeError("Parquet files can't be appended to, start over or use another output format")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        # explicit, since a row group of puzzles without `cp` can't tell its type
+        self.schema = pyarrow.schema([
+            ("white", pyarrow.string()),
+            ("black", pyarrow.string()),
+            ("game_id", pyarrow.string()),
+            ("fen", pyarrow.string()),
+            ("ply", pyarrow.int32()),
+            ("moves", pyarrow.list_(pyarrow.string())),
+            ("cp", pyarrow.int32()),
+            ("generator_version", pyarrow.string()),
+        ])
+        self.rows: List[Json] = []
+        self.writer: Any = None
+
+    def write_puzzle(self, puzzle: Json) -> None:
+        self.rows.append(puzzle)
+        if len(self.rows) >= PARQUET_ROW_GROUP:
+            self.write_row_group()
+
+    def write_row_group(self) -> None:
+        if self.rows:
+            table = self.pa.Table.from_pylist(self.rows, schema = self.schema)
+            if self.writer is None:
+                self.writer = self.pq.ParquetWriter(self.path, self.schema, compression = "zstd")
+            self.writer.write_table(table, row_group_size = PARQUET_ROW_GROUP)
+            self.rows = []
+
+    def close(self) -> None:
+        super().close()
+        self.write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def make_sink(name: str, format: str, append: bool) -> Sink:
+    "sink writing to `{name}.{format}`, after what is already there if `append`"
+    path = f"{name}.{format}"
+    if format == "csv":
+        return CsvSink(path, append)
+    if format.startswith("jsonl"):
+        return JsonlSink(path, append)
+    if format == "parquet":
+        return ParquetSink(path, append)
+    raise ValueError(f"Unknown output format {format}, expected one of {FORMATS}")
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import chess
+import chess.syzygy
+from chess import Board, Move
+from chess.engine import Cp, Mate, PovScore, Score, InfoDict
+from typing import List, Optional, Tuple
+
+# Kept identical in generator/ and tagger/ (checked by tagger/test.py)
+
+TB_WIN = 20_000 # centipawns of a won position, less its distance to zeroing, as Stockfish reports them
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--syzygy", help="directories of Syzygy tablebases, separated by ':'. Positions they cover are answered without the engine", metavar="DIR")
+    parser.add_argument("--syzygy-pieces", help="probe positions with up to this count of pieces, kings included", default="6")
+
+def open_tablebase(args: argparse.Namespace, logger: logging.Logger) -> Optional["Tablebase"]:
+    if not args.syzygy:
+        return None
+    tablebase = chess.syzygy.Tablebase()
+    for directory in args.syzygy.split(":"):
+        tablebase.add_directory(directory)
+    pieces = int(args.syzygy_pieces)
+    logger.info(f"Syzygy tablebases for up to {pieces} pieces from {args.syzygy}")
+    return Tablebase(tablebase, pieces)
+
+
+class Tablebase:
+    """
+    Exact scores of endgame positions from Syzygy tablebases, in the shape of engine
+    results. Wins score `TB_WIN` less the distance to zeroing, so that the quickest
+    conversion comes first, and draws including cursed wins score 0. Tablebases know
+    nothing of mate distances: mate lines stay with the engine.
+    """
+
+    def __init__(self, tablebase: chess.syzygy.Tablebase, pieces: int) -> None:
+        self.tablebase = tablebase
+        self.pieces = pieces
+
+    def covers(self, board: Board) -> bool:
+        return chess.popcount(board.occupied) <= self.pieces and not board.castling_rights
+
+    def score(self, board: Board) -> Optional[Score]:
+        "score of `board` for the side to move, None if it isn't in the tablebases"
+        if board.is_checkmate():
+            return Mate(0)
+        if board.is_stalemate() or board.is_insufficient_material():
+            return Cp(0)
+        if not self.covers(board) or board.was_into_check():
+            return None
+        try:
+            wdl = self.tablebase.probe_wdl(board)
+            if wdl in (-2, 2):
+                dtz = abs(self.tablebase.probe_dtz(board))
+                return Cp(TB_WIN - dtz if wdl > 0 else dtz - TB_WIN)
+        except KeyError: # table missing
+            return None
+        return Cp(0)
+
+    def lines(self, board: Board, multipv: int) -> Optional[List[InfoDict]]:
+        "the `multipv` best moves of `board`, as `engine.analyse` with `multipv` gives them, None if they aren't all in the tablebases"
+        if not self.covers(board):
+            return None
+        scored: List[Tuple[Score, Move]] = []
+        for move in board.legal_moves:
+            board.push(move)
+            score = Mate(-1) if board.is_checkmate() else self.score(board)
+            board.pop()
+            if score is None:
+                return None
+            scored.append((-score, move))
+        if not scored:
+            return None
+        scored.sort(key = lambda line: line[0], reverse = True)
+        return [{"score": PovScore(score, board.turn), "pv": [move]} for score, move in scored[:multipv]]
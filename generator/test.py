@@ -1,6 +1,18 @@
 import unittest
+import argparse
+import asyncio
 import logging
+import io
+import gzip
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
 import chess
+import zstandard
+import zst
 from model import Puzzle
 from generator import logger
 from server import Server
@@ -8,14 +20,32 @@ from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess import Move, Color, Board, WHITE, BLACK
 from chess.pgn import Game, GameNode
 from typing import List, Optional, Tuple, Literal, Union
-
-from generator import Generator, Server, make_engine
+from unittest.mock import Mock, patch
+from cache import CachedEngine, EarlyStop
+from evalstore import EvalStore
+from zst import SeekableZstd
+from scan import scan_headers, movetext_scores
+from bloom import BloomFilter
+from outbox import Outbox
+from sink import make_sink
+from checkpoint import Checkpoint
+from coordinator import Coordinator, RemoteRanges
+from engine_profile import EngineProfile, profile_of
+from metrics import Registry
+import tracing
+from bench import fake_engine, FAKE_ENGINE
+from replay import ReplayEngine
+from triage import hanging_value, select_plies, tactic_scores
+from tablebase import Tablebase, TB_WIN
+from util import node_eval
+
+from generator import Generator, AsyncGenerator, Server, make_engine, open_file, attack_verdict, swing_plies, has_swing
 
 class TestGenerator(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.engine = make_engine("stockfish", 6) # don't use more than 6 threads! it fails at finding mates
+        cls.engine = make_engine("stockfish", EngineProfile(threads = 6)) # don't use more than 6 threads! it fails at finding mates
         cls.server = Server(logger, "", "", 0)
         cls.gen = Generator(cls.engine, cls.server)
         logger.setLevel(logging.DEBUG)
@@ -188,5 +218,612 @@ class TestGenerator(unittest.TestCase):
         cls.engine.close()
 
 
+class TestNodeEval(unittest.TestCase):
+
+    def test_same_as_node_eval(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = chess.pgn.read_game(pgn)
+        board = game.board()
+        for node in game.mainline():
+            board.push(node.move)
+            self.assertEqual(node_eval(node, board.turn), node.eval())
+        node = Game().add_main_variation(Move.from_uci("f2f3"))
+        node.comment = "[%eval #0]"
+        self.assertEqual(node_eval(node, BLACK), node.eval())
+
+
+class TestSeekableZstd(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.text = b"".join(f"[Event \"game {i}\"]\n\n1. e4 e5 *\n\n".encode() for i in range(20_000))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, frames: List[bytes]) -> str:
+        file = os.path.join(self.dir.name, "games.pgn.zst")
+        cctx = zstandard.ZstdCompressor()
+        with open(file, "wb") as f:
+            for frame in frames:
+                f.write(cctx.compress(frame))
+        return file
+
+    def assert_seeks(self, file: str) -> None:
+        with SeekableZstd(file, logger) as f:
+            for offset in [len(self.text) - 17, 5, 300_000, 300_001, 0, 123_456]:
+                f.seek(offset)
+                self.assertEqual(f.read(100), self.text[offset:offset + 100])
+            self.assertEqual(f.read(), self.text[123_556:])
+
+    def test_multi_frame(self) -> None:
+        file = self.write([self.text[:100_000], self.text[100_000:400_000], self.text[400_000:]])
+        self.assertEqual(len(zst.load_index(file, logger)[1]), 3)
+        self.assert_seeks(file)
+
+    def test_reencode(self) -> None:
+        file = self.write([self.text])
+        with patch("zst.MAX_FRAME_SIZE", 200_000), patch("zst.FRAME_SIZE", 100_000):
+            data, frames = zst.load_index(file, logger)
+        self.assertEqual(data, zst.seekable_path(file))
+        self.assertGreater(len(frames), 1)
+        self.assert_seeks(file)
+
+    def test_text_offsets(self) -> None:
+        file = self.write([self.text[:100_000], self.text[100_000:]])
+        with open_file(file) as pgn:
+            offsets = []
+            while chess.pgn.read_headers(pgn) is not None:
+                offsets.append(pgn.tell())
+            pgn.seek(offsets[10_000])
+            self.assertEqual(pgn.readline(), '[Event "game 10001"]\n')
+
+
+class TestScanHeaders(unittest.TestCase):
+
+    def pgn(self) -> bytes:
+        with open("test_pgn_3fold_uDMCM.pgn", "rb") as f:
+            lichess = f.read()
+        wrapped = (b'[Event "Wrapped"]\n[White "Quote \\"Q\\" Player"]\n[Black "b"]\n\n'
+            b'1. e4 { a comment spanning\n[%clk 0:05:00] } 1... e5\n[%eval 0.2] 2. Nf3 *\n\n')
+        crlf = b'[Event "CRLF"]\r\n[Variant "Atomic"]\r\n\r\n1. e4 *\r\n\r\n'
+        return lichess + b"\n" + wrapped + crlf + lichess
+
+    def test_same_as_read_headers(self) -> None:
+        data = self.pgn()
+        pgn = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")
+        expected = []
+        while True:
+            headers = chess.pgn.read_headers(pgn)
+            if headers is None:
+                break
+            expected.append(dict(headers))
+        for chunk_size in [64, 1000, len(data)]:
+            scanned = list(scan_headers(io.BytesIO(data), chunk_size=chunk_size))
+            self.assertEqual(len(scanned), len(expected))
+            # read_headers also fills in the seven tag roster
+            self.assertEqual([h for _, h in scanned], [{k: e[k] for k in h} for (_, h), e in zip(scanned, expected)])
+            self.assertEqual(scanned[1][1]["White"], 'Quote \\"Q\\" Player')
+            self.assertEqual(scanned[2][1]["Variant"], "Atomic")
+            for offset, headers in scanned:
+                pgn.seek(offset)
+                self.assertEqual(chess.pgn.read_headers(pgn).get("Event"), headers["Event"])
+
+    def test_only_wanted_tags(self) -> None:
+        scanned = list(scan_headers(io.BytesIO(self.pgn()), ["White", "Variant"]))
+        self.assertEqual(scanned[0][1], {"White": "genassien", "Variant": "Standard"})
+
+
+class TestMovetextScores(unittest.TestCase):
+
+    def test_same_as_node_eval(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            scores = movetext_scores(pgn)
+            pgn.seek(0)
+            game = chess.pgn.read_game(pgn)
+        assert game is not None and scores is not None
+        board = game.board()
+        expected = []
+        for node in game.mainline():
+            board.push(node.move)
+            expected.append(node_eval(node, board.turn).pov(board.turn)) # type: ignore
+        self.assertEqual(scores, expected)
+        self.assertTrue(has_swing(scores))
+
+    def test_mate_and_missing_eval(self) -> None:
+        headers = '[Event "Rated Blitz game"]\n[Site "https://lichess.org/abcdefgh"]\n\n'
+        mate = "1. f3 { [%eval -0.5] } 1... e5 { [%eval -0.4] } 2. g4 { [%eval #-1] } ( 2. Kf2 { [%eval -1.0] } ) 2... Qh4# 0-1\n"
+        self.assertEqual(movetext_scores(io.StringIO(headers + mate)), [Cp(50), Cp(-40), Mate(1), Mate(0)])
+        quiet = "1. e4 { [%eval 0.2] } 1... e5 { [%eval 0.3] } 1/2-1/2\n"
+        self.assertFalse(has_swing(movetext_scores(io.StringIO(headers + quiet)))) # type: ignore
+        self.assertIsNone(movetext_scores(io.StringIO(headers + "1. e4 { [%eval 0.2] } 1... e5 2. Nf3 { [%eval 0.3] } *\n")))
+
+
+class TestCachedEngine(unittest.TestCase):
+
+    def test_lru(self) -> None:
+        engine = Mock()
+        engine.analyse.side_effect = lambda board, limit, multipv, root_moves: {"fen": board.fen(), "multipv": multipv}
+        cached = CachedEngine(engine, 2)
+        limit = chess.engine.Limit(depth = 10)
+        start, e4, d4 = Board(), Board(), Board()
+        e4.push_uci("e2e4")
+        d4.push_uci("d2d4")
+        self.assertEqual(cached.analyse(start, limit), {"fen": start.fen(), "multipv": None})
+        cached.analyse(start, limit)
+        cached.analyse(start, limit, multipv = 2)
+        cached.analyse(start, chess.engine.Limit(depth = 11))
+        self.assertEqual(engine.analyse.call_count, 3)
+        self.assertEqual((cached.hits, cached.misses), (1, 3))
+        cached.analyse(e4, limit)
+        cached.analyse(d4, limit)
+        cached.analyse(e4, limit)
+        cached.analyse(start, limit) # evicted
+        self.assertEqual(engine.analyse.call_count, 6)
+
+
+class TestEvalStore(unittest.TestCase):
+
+    def test_persisted(self) -> None:
+        info = {"score": PovScore(Mate(-2), BLACK), "pv": [Move.from_uci("e2e4"), Move.from_uci("e7e5")], "depth": 20, "nps": 1_000_000}
+        engine = Mock()
+        engine.id = {"name": "Stockfish 15"}
+        engine.analyse.return_value = [info, {"score": PovScore(Cp(-30), BLACK), "pv": [Move.from_uci("d2d4")]}]
+        engine.play.return_value = chess.engine.PlayResult(Move.from_uci("g1f3"), None)
+        limit = chess.engine.Limit(depth = 20)
+        board = Board()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "evals.sqlite")
+            store = EvalStore(path)
+            self.assertEqual(store.analyse(engine, board, limit, 2)[0], info)
+            self.assertEqual(store.play(engine, board, limit).move, Move.from_uci("g1f3"))
+            store.close()
+            store = EvalStore(path)
+            self.assertEqual(store.analyse(engine, board, limit, 2), engine.analyse.return_value)
+            self.assertEqual(store.play(engine, board, limit).move, Move.from_uci("g1f3"))
+            self.assertEqual(engine.analyse.call_count, 1)
+            self.assertEqual(engine.play.call_count, 1)
+            store.analyse(engine, board, limit, 3)
+            engine.id = {"name": "Stockfish 16"}
+            store.analyse(engine, board, limit, 2)
+            self.assertEqual(engine.analyse.call_count, 3)
+            store.close()
+
+class TestSeenLookups(unittest.TestCase):
+
+    def test_bloom_filter(self) -> None:
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f"pos{i}")
+        self.assertTrue(all(f"pos{i}" in bloom for i in range(1000)))
+        self.assertLess(sum(f"other{i}" in bloom for i in range(1000)), 50)
+
+    def test_batched_and_cached(self) -> None:
+        server = Server(logger, "http://validator", "token", "1")
+        board = Board()
+        board.push_uci("e2e4")
+        id = server.position_id(board)
+        self.assertEqual(id, f"{chess.STARTING_FEN}:e2e4")
+        with patch("server.http") as http:
+            http.post.return_value.json.return_value = {"seen": [id]}
+            server.are_seen([id, "abcdefgh"])
+            self.assertEqual(http.post.call_args[1]["json"], {"ids": [id, "abcdefgh"]})
+            self.assertTrue(server.is_seen_pos(board))
+            self.assertFalse(server.is_seen("abcdefgh"))
+            http.get.assert_not_called()
+
+    def test_bloom_prefetch(self) -> None:
+        server = Server(logger, "http://validator", "token", "1")
+        server.use_bloom(BloomFilter(10))
+        board = Board()
+        board.push_uci("e2e4")
+        with patch("server.http") as http:
+            self.assertFalse(server.is_seen_pos(board))
+            server.are_seen([server.position_id(board)])
+            http.get.assert_not_called()
+            http.post.assert_not_called()
+            server.bloom.add(server.position_id(board))
+            http.get.return_value.status_code = 200
+            self.assertTrue(server.is_seen_pos(board))
+            self.assertTrue(server.is_seen_pos(board))
+            self.assertEqual(http.get.call_count, 1)
+
+    def test_bloom_expires(self) -> None:
+        server = Server(logger, "http://validator", "token", "1")
+        server.use_bloom(BloomFilter(10))
+        board = Board()
+        board.push_uci("e2e4")
+        with patch("server.http") as http:
+            http.get.return_value.status_code = 200
+            with patch("server.time.monotonic", return_value = time.monotonic() + 3600):
+                # posted by another process since the prefetch
+                self.assertTrue(server.is_seen_pos(board))
+            self.assertEqual(http.get.call_count, 1)
+        self.assertIsNone(server.bloom)
+
+    def test_unseen_expires_and_posted_is_seen(self) -> None:
+        server = Server(logger, "http://validator", "token", "1")
+        server.use_bloom(BloomFilter(10))
+        board = Board()
+        board.push_uci("e2e4")
+        id = server.position_id(board)
+        with patch("server.http") as http:
+            server.bloom.add(id)
+            http.get.return_value.status_code = 404
+            self.assertFalse(server.is_seen_pos(board))
+            self.assertFalse(server.is_seen_pos(board))
+            self.assertEqual(http.get.call_count, 1)
+            http.get.return_value.status_code = 200
+            with patch("server.time.monotonic", return_value = time.monotonic() + 3600):
+                self.assertTrue(server.is_seen_pos(board))
+            self.assertEqual(http.get.call_count, 2)
+        other = Board()
+        other.push_uci("d2d4")
+        server.outbox = Mock()
+        server.post_json({"fen": chess.STARTING_FEN, "moves": ["d2d4", "d7d5"]})
+        with patch("server.http") as http:
+            self.assertTrue(server.is_seen_pos(other))
+            http.get.assert_not_called()
+
+class TestOutbox(unittest.TestCase):
+
+    def test_batches(self) -> None:
+        sent: List[List[dict]] = []
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = os.path.join(tmp, "spool.jsonl")
+            outbox = Outbox(logger, sent.append, spool, batch_size = 2, flush_interval = 0.1)
+            for i in range(3):
+                outbox.put({"game_id": i})
+            outbox.close(5)
+            self.assertEqual(sent, [[{"game_id": 0}, {"game_id": 1}], [{"game_id": 2}]])
+            self.assertEqual(os.path.getsize(spool), 0)
+
+    def test_replay_unsent(self) -> None:
+        def down(batch: List[dict]) -> None:
+            raise ConnectionError("validator down")
+        sent: List[List[dict]] = []
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = os.path.join(tmp, "spool.jsonl")
+            outbox = Outbox(logging.getLogger("test"), down, spool, flush_interval = 0)
+            outbox.put({"game_id": 0})
+            outbox.put({"game_id": 1})
+            outbox.close(0.1)
+            outbox = Outbox(logger, sent.append, spool, flush_interval = 0)
+            outbox.close(5)
+            self.assertEqual(sum(sent, []), [{"game_id": 0}, {"game_id": 1}])
+
+class TestSink(unittest.TestCase):
+
+    puzzles = [{"game_id": "abcdefgh", "moves": ["e2e4", "e7e5"], "cp": None}, {"game_id": "ijklmnop", "moves": ["d2d4"], "cp": 250}]
+
+    def test_csv_append(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "out")
+            for append, puzzle in [(False, self.puzzles[0]), (True, self.puzzles[1])]:
+                sink = make_sink(name, "csv", append)
+                sink.write(puzzle)
+                sink.close()
+            with open(f"{name}.csv") as f:
+                self.assertEqual(f.read().splitlines()[0], "game_id,moves,cp")
+                f.seek(0)
+                self.assertEqual(len(f.readlines()), 3)
+
+    def test_jsonl(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "out")
+            for format in ["jsonl.gz", "jsonl.zst"]:
+                for append, puzzle in [(False, self.puzzles[0]), (True, self.puzzles[1])]:
+                    sink = make_sink(name, format, append)
+                    sink.write(puzzle)
+                    sink.close()
+                with open(f"{name}.{format}", "rb") as f:
+                    if format.endswith("gz"):
+                        data = gzip.decompress(f.read())
+                    else:
+                        data = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames = True).read()
+                self.assertEqual([json.loads(line) for line in data.splitlines()], self.puzzles)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "needs pyarrow")
+    def test_parquet_row_groups(self) -> None:
+        import pyarrow.parquet
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "out")
+            sink = make_sink(name, "parquet", False)
+            for puzzle in self.puzzles * 3:
+                sink.last_flush = 0 # as if each puzzle came after the flush interval
+                sink.write(puzzle)
+            sink.close()
+            file = pyarrow.parquet.ParquetFile(f"{name}.parquet")
+            self.assertEqual((file.metadata.num_row_groups, file.metadata.num_rows), (1, 6))
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_out_of_order(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "games.checkpoint.json")
+            checkpoint = Checkpoint(path, "games.pgn", logger)
+            for i, offset in enumerate([0, 100, 200]):
+                checkpoint.dispatched(i, offset)
+            checkpoint.finished(1)
+            checkpoint.found()
+            checkpoint.write()
+            self.assertFalse(os.path.exists(path))
+            checkpoint.finished(0)
+            checkpoint.write()
+            previous = Checkpoint.load(path, "games.pgn")
+            self.assertEqual(previous, {"file": "games.pgn", "offset": 100, "games": 2, "puzzles": 1})
+            with self.assertRaises(ValueError):
+                Checkpoint.load(path, "other.pgn")
+
+class TestEarlyStop(unittest.TestCase):
+
+    def lines(self, depth: int, best: int, second: int) -> List[dict]:
+        return [
+            {"depth": depth, "multipv": 1, "score": PovScore(Cp(best), WHITE), "pv": [Move.from_uci("e2e4")]},
+            {"depth": depth, "multipv": 2, "score": PovScore(Cp(second), WHITE), "pv": [Move.from_uci("d2d4")]},
+        ]
+
+    def stops_at(self, scores: List[Tuple[int, int]]) -> Optional[int]:
+        stop = EarlyStop(lambda lines: attack_verdict(WHITE, lines), 2, min_depth = 3, stable_depths = 2)
+        for depth, (best, second) in enumerate(scores, 1):
+            if any([stop.update(info) for info in self.lines(depth, best, second)]):
+                return depth
+        return None
+
+    def test_decided(self) -> None:
+        self.assertEqual(self.stops_at([(900, 0)] * 5), 3)
+        self.assertEqual(self.stops_at([(0, 0)] * 5), 3)
+
+    def test_unstable(self) -> None:
+        self.assertEqual(self.stops_at([(900, 0), (0, 0), (900, 0), (900, 0), (900, 0)]), 4)
+        self.assertIsNone(self.stops_at([(400, 0)] * 5)) # too close to tell
+
+    def test_mates(self) -> None:
+        stop = EarlyStop(lambda lines: attack_verdict(WHITE, lines), 2, min_depth = 1, stable_depths = 1)
+        info = {"depth": 1, "score": PovScore(Mate(1), WHITE), "pv": [Move.from_uci("e2e4")]}
+        self.assertFalse(stop.update({**info, "multipv": 1}))
+        self.assertFalse(stop.update({**info, "multipv": 2}))
+
+class TestSwingPlies(unittest.TestCase):
+
+    def test_swings(self) -> None:
+        scores: List[Tuple[int, Score]] = [(1, Cp(-20)), (2, Cp(30)), (3, Cp(-30)), (4, Cp(400)), (5, Cp(-400)), (6, Cp(-20)), (7, Mate(5))]
+        self.assertEqual(swing_plies(scores), {3, 4, 6, 7})
+
+    def test_quiet(self) -> None:
+        self.assertEqual(swing_plies([(ply, Cp(10 * (-1) ** ply)) for ply in range(1, 40)]), set())
+
+class TestEngineProfile(unittest.TestCase):
+
+    def test_precedence(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "engine.json")
+            with open(path, "w") as f:
+                json.dump({"threads": 8, "hash": 1024, "options": {"Move Overhead": 0}}, f)
+            args = argparse.Namespace(engine_config = path, hash = 512, clear_hash = None)
+            profile = profile_of(args, None)
+            self.assertEqual(profile, EngineProfile(threads = 8, hash = 512, options = {"Move Overhead": 0}))
+            self.assertEqual(profile_of(argparse.Namespace(engine_config = None, hash = None, clear_hash = True), 2), EngineProfile(threads = 2, clear_hash = True))
+            engine = Mock()
+            engine.options = {"Threads": None, "Hash": None}
+            self.assertEqual(profile.uci_options(engine), {"Threads": 8, "Hash": 512})
+
+class TestCoordinator(unittest.TestCase):
+
+    def test_leases(self) -> None:
+        with tempfile.NamedTemporaryFile() as f:
+            coordinator = Coordinator(f.name, list(range(0, 500, 100)), logger, range_size = 2, lease_seconds = 60)
+            self.assertEqual(coordinator.lease("a"), {"range": 0, "offsets": [0, 100]})
+            self.assertEqual(coordinator.lease("b"), {"range": 1, "offsets": [200, 300]})
+            self.assertEqual(coordinator.lease("b"), {"range": 2, "offsets": [400]})
+            self.assertIn("wait", coordinator.lease("c"))
+            coordinator.progress("b", {"ranges": [1, 2], "games": 3, "knps": 1000})
+            coordinator.leases[0] = ("a", 0) # a stopped renewing
+            self.assertEqual(coordinator.lease("c"), {"range": 0, "offsets": [0, 100]})
+            coordinator.progress("a", {"ranges": [0]}) # too late, c has it
+            self.assertEqual(coordinator.leases[0][0], "c")
+            for range_id in range(3):
+                coordinator.complete("b", range_id)
+            self.assertEqual(coordinator.lease("c"), {"done": True})
+            status = coordinator.status()
+            self.assertEqual((status["done"], status["games"], status["knps"]), (3, 3, 1000))
+
+    def test_other_file(self) -> None:
+        with tempfile.NamedTemporaryFile() as f, patch("coordinator.requests") as requests:
+            requests.get.return_value.json.return_value = {"size": 10}
+            with self.assertRaises(ValueError):
+                RemoteRanges("http://coordinator:8000", f.name, "w", logger)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_merge_workers(self) -> None:
+        registry = Registry()
+        calls = registry.counter("calls_total", "calls", ("kind",))
+        seconds = registry.histogram("seconds", "seconds", buckets = [1, 10])
+        calls.inc(1, "pair")
+        seconds.observe(0.5)
+        worker = Registry()
+        worker.counter("calls_total", "calls", ("kind",)).inc(2, "pair")
+        worker.histogram("seconds", "seconds", buckets = [1, 10]).observe(20)
+        registry.absorb(1, worker.snapshot())
+        registry.absorb(1, worker.snapshot()) # replaces the previous snapshot of worker 1
+        self.assertEqual(registry.merged(), {"calls_total": {("pair",): 3}, "seconds": {(): ([1, 0, 1], 20.5)}})
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'calls_total{kind="pair"} 3',
+            "# HELP seconds seconds",
+            "# TYPE seconds histogram",
+            'seconds_bucket{le="1"} 1',
+            'seconds_bucket{le="10"} 1',
+            'seconds_bucket{le="+Inf"} 2',
+            "seconds_sum 20.5",
+            "seconds_count 2",
+        ])
+
+class TestTracing(unittest.TestCase):
+
+    def test_nested_spans(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "trace.jsonl")
+            writer = tracing.Writer(path)
+            with tracing.game(writer, 3) as game_trace:
+                game_trace.set(game = "abcdefgh")
+                with tracing.span("probe", ply = 10) as probe:
+                    with tracing.span("search", kind = "pair"):
+                        pass
+                    probe.set(puzzle = True)
+                with tracing.span("post"):
+                    pass
+            with tracing.game(None, 4):
+                self.assertIs(tracing.span("search", kind = "pair"), tracing.NULL_SPAN)
+            writer.close()
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]["index"], records[0]["game"]), (3, "abcdefgh"))
+        self.assertEqual(
+            [(s["id"], s["parent"], s["name"]) for s in records[0]["spans"]],
+            [(0, None, "probe"), (1, 0, "search"), (2, None, "post")])
+        self.assertEqual(records[0]["spans"][0]["puzzle"], True)
+
+class TestFakeEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = fake_engine("")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.quit()
+
+    def test_mate_in_one_first(self) -> None:
+        board = Board("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1")
+        info = self.engine.analyse(board, chess.engine.Limit(depth = 10), multipv = 2)
+        self.assertEqual((info[0]["pv"][0], info[0]["score"].relative), (Move.from_uci("a1a8"), Mate(1)))
+        self.assertEqual(info, self.engine.analyse(board, chess.engine.Limit(depth = 10), multipv = 2))
+
+    def test_generator(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = chess.pgn.read_game(pgn)
+        assert game is not None
+        puzzle = Generator(self.engine, Server(logger, "", "", 0)).analyze_game(game, 10)
+        self.assertIsNotNone(puzzle)
+
+    def test_cook_mate(self) -> None:
+        generator = Generator(self.engine, Server(logger, "", "", 0))
+        board = Board("6k1/5ppp/8/7q/8/8/5PPP/R5K1 w - - 0 1")
+        self.assertEqual(generator.cook_mate(board, WHITE, 1), [Move.from_uci("a1a8")])
+        # two mates in one, and the best other move wins a queen up
+        board = Board("k7/8/1K6/8/8/8/8/7Q w - - 0 1")
+        self.assertIsNone(generator.cook_mate(board, WHITE, 1))
+        info = self.engine.analyse(board, chess.engine.Limit(depth = 10), root_moves = [Move.from_uci("h1h2"), Move.from_uci("h1b7")])
+        self.assertEqual(info["pv"][0], Move.from_uci("h1b7"))
+
+class TestAsyncGenerator(unittest.TestCase):
+
+    def test_concurrent_games(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = chess.pgn.read_game(pgn)
+        assert game is not None
+        engine = fake_engine("")
+        expected = Generator(engine, Server(logger, "", "", 0)).analyze_game(game, 10)
+        engine.quit()
+        assert expected is not None
+
+        async def analyse_twice() -> Tuple[List[Optional[Puzzle]], int, int]:
+            _, protocol = await chess.engine.popen_uci([sys.executable, FAKE_ENGINE])
+            generator = AsyncGenerator(protocol, Server(logger, "", "", 0))
+            try:
+                puzzles = await asyncio.gather(generator.analyze_game(game, 10), generator.analyze_game(game, 10))
+            finally:
+                await generator.engine.quit()
+            return list(puzzles), generator.engine.hits, generator.engine.misses
+
+        puzzles, hits, misses = asyncio.run(analyse_twice())
+        for puzzle in puzzles:
+            assert puzzle is not None
+            self.assertEqual((puzzle.node.ply(), puzzle.moves), (expected.node.ply(), expected.moves))
+        # the second game waits for the searches of the first, then finds them in the cache
+        self.assertGreater(misses, 0)
+        self.assertEqual(hits, misses)
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_record_then_replay(self) -> None:
+        info = {"score": PovScore(Cp(35), WHITE), "pv": [Move.from_uci("e2e4")], "depth": 20}
+        engine = Mock()
+        engine.id = {"name": "Fake"}
+        engine.options = {"Threads": None, "Clear Hash": None}
+        engine.analyse.return_value = [info]
+        engine.play.return_value = chess.engine.PlayResult(Move.from_uci("d2d4"), None)
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            recorder = ReplayEngine(lambda: engine, dir, logger, replay = False)
+            self.assertEqual(recorder.analyse(Board(), limit, multipv = 2), [info])
+            recorder.play(Board(), limit)
+            recorder.close()
+            replayer = ReplayEngine(Mock(side_effect = AssertionError("engine started")), dir, logger, replay = True)
+            self.assertEqual(replayer.analyse(Board(), limit, multipv = 2), [info])
+            self.assertEqual(replayer.play(Board(), limit).move, Move.from_uci("d2d4"))
+            self.assertEqual((replayer.id, "Clear Hash" in replayer.options), ({"name": "Fake"}, True))
+            self.assertEqual((replayer.hits, replayer.misses), (2, 0))
+            replayer.close()
+        self.assertEqual(engine.analyse.call_count, 1)
+
+
+class TestTriage(unittest.TestCase):
+
+    def test_hanging_value(self) -> None:
+        board = Board("4k3/8/8/3q4/8/8/8/3RK3 w - - 0 1")
+        self.assertEqual((hanging_value(board, WHITE), hanging_value(board, BLACK)), (9, 0))
+        board = Board("4k3/8/4p3/3q4/8/8/8/3RK3 w - - 0 1")
+        self.assertEqual(hanging_value(board, WHITE), 4)
+
+    def test_select_plies(self) -> None:
+        scores = {1: 0, 2: 3, 3: 0, 4: 0, 5: 1, 6: 0}
+        self.assertEqual(select_plies(scores, 0.1), {1, 2, 3})
+        self.assertEqual(select_plies(scores, 0.3, neighbours = 0), {2, 5})
+        self.assertEqual(select_plies(scores, 1), set(scores))
+
+    def test_keeps_the_swings(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = chess.pgn.read_game(pgn)
+        assert game is not None
+        scores = tactic_scores(game)
+        self.assertEqual(set(scores), set(range(1, game.end().ply() + 1)))
+        kept = select_plies(scores, 0.5)
+        self.assertLess(len(kept), len(scores))
+        self.assertTrue({77, 79, 81, 83, 85} <= kept) # the plies probed with the evals of the game
+
+
+class TestTablebase(unittest.TestCase):
+
+    def tablebase(self) -> Tablebase:
+        syzygy = Mock()
+        syzygy.probe_wdl.return_value = -2 # queen up, the other side loses
+        syzygy.probe_dtz.side_effect = lambda board: -board.legal_moves.count()
+        return Tablebase(syzygy, 5)
+
+    def test_lines(self) -> None:
+        board = Board("k7/8/1K6/8/8/8/8/6Q1 w - - 0 1")
+        lines = self.tablebase().lines(board, 2)
+        assert lines is not None
+        self.assertEqual((lines[0]["pv"], lines[0]["score"]), ([Move.from_uci("g1g8")], PovScore(Mate(1), WHITE)))
+        self.assertEqual(lines[1]["score"], PovScore(Cp(TB_WIN - 1), WHITE))
+        self.assertEqual(board.fen(), "k7/8/1K6/8/8/8/8/6Q1 w - - 0 1")
+        self.assertIsNone(self.tablebase().lines(Board(), 2))
+
+    def test_pair_without_engine(self) -> None:
+        engine = Mock(side_effect = AssertionError("engine searched"))
+        generator = Generator(engine, Server(logger, "", "", 0), tablebase = self.tablebase())
+        board = Board("k7/8/1K6/8/8/8/8/6Q1 w - - 0 1")
+        self.assertIsNone(generator.get_next_pair(board, WHITE)) # winning moves other than the mate
+        pair = generator.get_next_pair(board, BLACK)
+        assert pair is not None and pair.second is not None
+        self.assertEqual((pair.best.move, pair.best.score), (Move.from_uci("g1g8"), Mate(-1)))
+        self.assertEqual(pair.second.score, Cp(1 - TB_WIN))
+        self.assertEqual(engine.analyse.call_count, 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,89 @@
+import argparse
+import json
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Tuple
+
+Json = Dict[str, Any]
+
+def read_traces(path: str) -> Iterator[Json]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def step(span: Json) -> str:
+    "what a span spent its time on, searches by kind and server calls by call"
+    if span["name"] == "search":
+        return f"search {span['kind']}{' (cached)' if span.get('cached') else ''}"
+    if span["name"] == "server":
+        return f"server {span['call']}"
+    return span["name"]
+
+def descendants(spans: List[Json], id: int) -> List[Json]:
+    "spans opened within the span `id`, spans being in the order they were opened"
+    inside = {id}
+    found = []
+    for span in spans[id + 1:]:
+        if span["parent"] in inside:
+            inside.add(span["id"])
+            found.append(span)
+    return found
+
+def searches(spans: List[Json]) -> Tuple[int, float, int]:
+    "count, seconds and nodes of the searches of `spans` the engine actually did"
+    done = [s for s in spans if s["name"] == "search" and not s.get("cached")]
+    return len(done), sum(s["seconds"] for s in done), sum(s.get("nodes", 0) for s in done)
+
+def slowest_games(traces: List[Json], top: int) -> List[str]:
+    lines = [f"{'seconds':>9} {'searches':>8} {'search s':>9} {'probes':>6} {'server s':>9}  game"]
+    for trace in sorted(traces, key = lambda t: -t["seconds"])[:top]:
+        spans = trace["spans"]
+        count, seconds, _ = searches(spans)
+        probes = sum(1 for s in spans if s["name"] == "probe")
+        server = sum(s["seconds"] for s in spans if s["name"] == "server")
+        flags = " puzzle" if trace.get("puzzle") else " error" if "error" in trace else ""
+        lines.append(f"{trace['seconds']:9.2f} {count:8} {seconds:9.2f} {probes:6} {server:9.2f}  {trace.get('game', '?')} #{trace['index']}{flags}")
+    return lines
+
+def slowest_positions(traces: List[Json], top: int) -> List[str]:
+    probes = [(trace, span) for trace in traces for span in trace["spans"] if span["name"] == "probe"]
+    lines = [f"{'seconds':>9} {'searches':>8} {'knodes':>9} {'kind':>9} {'ply':>4}  game, fen"]
+    for trace, span in sorted(probes, key = lambda p: -p[1]["seconds"])[:top]:
+        count, _, nodes = searches(descendants(trace["spans"], span["id"]))
+        outcome = " seen" if span.get("seen") else " puzzle" if span.get("puzzle") else ""
+        lines.append(f"{span['seconds']:9.2f} {count:8} {nodes // 1000:9} {span['kind']:>9} {span['ply']:4}  {trace.get('game', '?')}{outcome}, {span['fen']}")
+    return lines
+
+def time_by_step(traces: List[Json]) -> List[str]:
+    "steps that don't nest in one another, so that their times add up"
+    times: Dict[str, List[float]] = defaultdict(list)
+    for trace in traces:
+        for span in trace["spans"]:
+            if span["name"] != "probe":
+                times[step(span)].append(span["seconds"])
+    total = sum(t["seconds"] for t in traces) or 1
+    lines = [f"{'seconds':>9} {'share':>6} {'count':>7} {'mean':>8} {'max':>8}  step"]
+    for name, seconds in sorted(times.items(), key = lambda t: -sum(t[1])):
+        lines.append(f"{sum(seconds):9.2f} {sum(seconds) / total:6.1%} {len(seconds):7} {sum(seconds) / len(seconds):8.3f} {max(seconds):8.2f}  {name}")
+    return lines
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='trace_report.py',
+        description='ranks the slowest games and positions of a trace written by generator.py --trace')
+    parser.add_argument("file", help="trace file", metavar="FILE.jsonl")
+    parser.add_argument("--top", help="count of games and positions listed", type=int, default=20)
+    args = parser.parse_args()
+
+    traces = list(read_traces(args.file))
+    print(f"{len(traces)} games, {sum(t['seconds'] for t in traces):.0f}s")
+    for title, lines in [
+        ("Slowest games", slowest_games(traces, args.top)),
+        ("Slowest positions probed", slowest_positions(traces, args.top)),
+        ("Time by step", time_by_step(traces)),
+    ]:
+        print(f"\n{title}")
+        print("\n".join(lines))
+
+if __name__ == "__main__":
+    main()
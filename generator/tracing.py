@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+Json = Dict[str, Any]
+
+class Span:
+    "one timed step of a game, `attrs` being whatever tells what it did"
+
+    def __init__(self, trace: "GameTrace", name: str, attrs: Json) -> None:
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.id = len(trace.spans)
+        self.parent: Optional[int] = None
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.parent = self.trace.stack[-1].id if self.trace.stack else None
+        self.trace.spans.append(self)
+        self.trace.stack.append(self)
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, type: Any, value: Any, traceback: Any) -> None:
+        self.seconds = time.monotonic() - self.start
+        if value is not None:
+            self.attrs["error"] = repr(value)
+        self.trace.stack.pop()
+
+    def record(self) -> Json:
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start": round(self.start - self.trace.start, 6),
+            "seconds": round(getattr(self, "seconds", time.monotonic() - self.start), 6),
+            **self.attrs,
+        }
+
+
+class NullSpan:
+    "what `span` returns when the game isn't traced"
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class GameTrace:
+    """
+    Spans of the analysis of one game, nested as they were opened. The steps of a game
+    run one after the other, even when games in flight share an engine with asyncio.
+    """
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.attrs: Json = {}
+        self.spans: List[Span] = []
+        self.stack: List[Span] = []
+        self.start = time.monotonic()
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def record(self) -> Json:
+        return {
+            "index": self.index,
+            **self.attrs,
+            "seconds": round(time.monotonic() - self.start, 6),
+            "spans": [span.record() for span in self.spans],
+        }
+
+
+class Writer:
+    """
+    Appends one json line per game to `path`. Each line is written at once to a file
+    opened in append mode, so worker processes can share it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def write(self, record: Json) -> None:
+        os.write(self.fd, (json.dumps(record) + "\n").encode())
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+# the game being analysed by the current thread or asyncio task, if traced
+current: ContextVar[Optional[GameTrace]] = ContextVar("trace", default = None)
+
+def active() -> bool:
+    return current.get() is not None
+
+def span(name: str, **attrs: Any) -> Any:
+    "`Span` of the game being traced, to use with `with`, or one doing nothing"
+    trace = current.get()
+    return NULL_SPAN if trace is None else Span(trace, name, attrs)
+
+@contextmanager
+def game(writer: Optional[Writer], index: int) -> Iterator[Any]:
+    """
+    Trace the steps of game `index` until the end of the block, then write them,
+    if there is a `writer`. Yields the `GameTrace`, or `NULL_SPAN` to set attributes on all the same.
+    """
+    if writer is None:
+        yield NULL_SPAN
+        return
+    trace = GameTrace(index)
+    token = current.set(trace)
+    try:
+        yield trace
+    finally:
+        current.reset(token)
+        writer.write(trace.record())
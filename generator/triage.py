@@ -0,0 +1,72 @@
+import math
+import chess
+from chess import Board, Color
+from chess.pgn import Game
+from util import material_diff
+from typing import Dict, List, Set
+
+values = { chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 0 }
+
+lookahead = 4 # plies of the game after a position where material won counts for it
+mate_lookahead = 8 # plies before a checkmate ending the game where positions count as leading to it
+
+def hanging_value(board: Board, side: Color) -> int:
+    "value `side` can win at once: the best piece of the other side it attacks, undefended or attacked by a cheaper piece"
+    best = 0
+    for square, piece in board.piece_map().items():
+        if piece.color == side or piece.piece_type == chess.KING:
+            continue
+        attackers = board.attackers(side, square)
+        if not attackers:
+            continue
+        value = values[piece.piece_type]
+        if not board.attackers(not side, square):
+            best = max(best, value)
+        else:
+            cheapest = min(values[board.piece_type_at(attacker)] for attacker in attackers) # type: ignore
+            best = max(best, value - cheapest)
+    return best
+
+def checks(board: Board, limit: int = 3) -> int:
+    "count of checking moves of the side to move, up to `limit`"
+    count = 0
+    for move in board.legal_moves:
+        if board.gives_check(move):
+            count += 1
+            if count >= limit:
+                break
+    return count
+
+def tactic_scores(game: Game) -> Dict[int, float]:
+    """
+    How likely the position after each mainline move is to start a tactic for the side
+    to move, by ply, without engine: material it can win at once, checks it has, material
+    it went on to win in the game, and a checkmate coming. Only meant to rank the plies.
+    """
+    board = game.board()
+    boards: List[Board] = []
+    diffs: List[int] = [] # material of white minus black, after each move
+    for node in game.mainline():
+        board.push(node.move)
+        boards.append(board.copy(stack = False))
+        diffs.append(material_diff(board, chess.WHITE))
+    mated = board.is_checkmate()
+    scores: Dict[int, float] = {}
+    for i, position in enumerate(boards):
+        side = position.turn
+        sign = 1 if side == chess.WHITE else -1
+        ahead = diffs[i + 1:i + 1 + lookahead]
+        won = max([sign * (diff - diffs[i]) for diff in ahead], default = 0)
+        score = (
+            hanging_value(position, side)
+            + 0.5 * checks(position)
+            + max(won, 0)
+            + (5 if mated and len(boards) - 1 - i <= mate_lookahead else 0)
+        )
+        scores[position.ply()] = score
+    return scores
+
+def select_plies(scores: Dict[int, float], keep: float, neighbours: int = 1) -> Set[int]:
+    "the `keep` fraction of the plies with the best scores, and the ones up to `neighbours` plies around them"
+    top = sorted(scores, key = lambda ply: (-scores[ply], ply))[:math.ceil(keep * len(scores))]
+    return {ply + d for ply in top for d in range(-neighbours, neighbours + 1) if ply + d in scores}
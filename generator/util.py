@@ -2,13 +2,12 @@ from dataclasses import dataclass
 import math
 import chess
 import chess.engine
+import chess.pgn
 from model import EngineMove, NextMovePair
-from chess import Color, Board
-from chess.pgn import GameNode
-from chess.engine import SimpleEngine, Score
-from typing import Optional
-
-nps = []
+from chess import Color, Board, Move
+from chess.engine import InfoDict, Score, PovScore, Cp, Mate
+from chess.pgn import ChildNode
+from typing import List, Optional
 
 def material_count(board: Board, side: Color) -> int:
     values = { chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9 }
@@ -27,19 +26,25 @@ def maximum_castling_rights(board: chess.Board) -> chess.Bitboard:
     )
 
 
-def get_next_move_pair(engine: SimpleEngine, node: GameNode, winner: Color, limit: chess.engine.Limit) -> NextMovePair:
-    info = engine.analyse(node.board(), multipv = 2, limit = limit)
-    global nps
-    nps.append(info[0]["nps"] / 1000)
-    nps = nps[-10000:]
+def next_move_pair(info: List[InfoDict], board: Board, winner: Color) -> NextMovePair:
     # print(info)
     best = EngineMove(info[0]["pv"][0], info[0]["score"].pov(winner))
     second = EngineMove(info[1]["pv"][0], info[1]["score"].pov(winner)) if len(info) > 1 else None
-    return NextMovePair(node, winner, best, second)
+    return NextMovePair(board, winner, best, second)
 
-def avg_knps():
-    global nps
-    return round(sum(nps) / len(nps)) if nps else 0
+def node_eval(node: ChildNode, turn: Color) -> Optional[PovScore]:
+    "`node.eval()` without walking back to the root of the game to know whose turn it is"
+    match = chess.pgn.EVAL_REGEX.search(node.comment)
+    if not match:
+        return None
+    if match.group(1):
+        mate = int(match.group(1))
+        score: Score = Mate(mate)
+        if mate == 0:
+            return PovScore(score, turn)
+    else:
+        score = Cp(int(float(match.group(2)) * 100))
+    return PovScore(score if turn else -score, turn)
 
 def win_chances(score: Score) -> float:
     """
@@ -69,14 +74,14 @@ def time_control_tier(line: str) -> Optional[int]:
     except:
         return 0
     
-def count_mates(board:chess.Board) -> int:
-    mates = 0
+def non_mating_moves(board: chess.Board) -> List[Move]:
+    moves = []
     for move in board.legal_moves:
         board.push(move)
-        if board.is_checkmate():
-            mates += 1
+        if not board.is_checkmate():
+            moves.append(move)
         board.pop()
-    return mates
+    return moves
 
 def rating_tier(line: str) -> Optional[int]:
     if not line.startswith("[WhiteElo ") and not line.startswith("[BlackElo "):
@@ -0,0 +1,161 @@
+import bisect
+import io
+import json
+import logging
+import os
+import zstandard
+from typing import List, Optional, Tuple
+
+CHUNK_SIZE = 1024 * 1024
+FRAME_SIZE = 4 * 1024 * 1024 # decompressed size of each frame when re-encoding
+MAX_FRAME_SIZE = 64 * 1024 * 1024 # files with bigger frames get re-encoded
+
+# (decompressed offset, compressed offset) of the start of each frame
+Frames = List[Tuple[int, int]]
+
+def index_path(file: str) -> str:
+    return f"{file}.idx"
+
+def seekable_path(file: str) -> str:
+    return f"{file[:-len('.zst')]}.seekable.zst"
+
+def scan_frames(file: str) -> Optional[Frames]:
+    """
+    Index the frames of `file` as they are, or return None if one of them is too big
+    for seeking inside it to be cheap (a lichess dump is usually a single frame).
+    """
+    dctx = zstandard.ZstdDecompressor()
+    frames: Frames = []
+    decompressed = 0
+    compressed = 0
+    obj = None
+    pending = b""
+    with open(file, "rb") as fh:
+        while True:
+            chunk = pending or fh.read(CHUNK_SIZE)
+            pending = b""
+            if not chunk:
+                break
+            if obj is None:
+                frames.append((decompressed, compressed))
+                obj = dctx.decompressobj()
+            decompressed += len(obj.decompress(chunk))
+            if decompressed - frames[-1][0] > MAX_FRAME_SIZE:
+                return None
+            if obj.eof:
+                pending = obj.unused_data
+                obj = None
+            compressed += len(chunk) - len(pending)
+    return frames
+
+def reencode(file: str, data: str) -> Frames:
+    "write the content of `file` to `data` as independent frames of `FRAME_SIZE` bytes"
+    cctx = zstandard.ZstdCompressor()
+    frames: Frames = []
+    decompressed = 0
+    compressed = 0
+    with open(file, "rb") as fh, open(data, "wb") as out:
+        reader = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True)
+        while True:
+            chunk = reader.read(FRAME_SIZE)
+            if not chunk:
+                break
+            frame = cctx.compress(chunk)
+            out.write(frame)
+            frames.append((decompressed, compressed))
+            decompressed += len(chunk)
+            compressed += len(frame)
+    return frames
+
+def load_index(file: str, logger: logging.Logger) -> Tuple[str, Frames]:
+    """
+    Return the file to read from and its frames, building the index sidecar the first time.
+    """
+    stat = os.stat(file)
+    try:
+        with open(index_path(file)) as f:
+            index = json.load(f)
+        if index["source_size"] == stat.st_size and index["source_mtime"] == stat.st_mtime:
+            data = os.path.join(os.path.dirname(file), index["data"])
+            return data, [(d, c) for d, c in index["frames"]]
+        logger.info(f"{file} changed since its index was built")
+    except FileNotFoundError:
+        pass
+    logger.info(f"Indexing zstd frames of {file}...")
+    data = file
+    frames = scan_frames(file)
+    if frames is None:
+        data = seekable_path(file)
+        logger.info(f"Frames of {file} too big to seek in, re-encoding to {data}...")
+        frames = reencode(file, data)
+    with open(index_path(file), "w") as f:
+        json.dump({
+            "data": os.path.basename(data),
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime,
+            "frames": frames,
+        }, f)
+    logger.info(f"{len(frames)} frames indexed")
+    return data, frames
+
+
+class SeekableZstd(io.RawIOBase):
+    """
+    Decompressed view of a zstd file where seeking only decompresses from the start
+    of the frame holding the target offset.
+    """
+
+    def __init__(self, file: str, logger: logging.Logger) -> None:
+        self.name = file
+        data, frames = load_index(file, logger)
+        self.starts = [d for d, _ in frames]
+        self.frames = frames
+        self.fh = open(data, "rb")
+        self.dctx = zstandard.ZstdDecompressor()
+        self.reader: Optional[zstandard.ZstdDecompressionReader] = None
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def frame_of(self, pos: int) -> int:
+        return max(bisect.bisect_right(self.starts, pos) - 1, 0)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            raise io.UnsupportedOperation("can't seek from the end of a zstd stream")
+        frame = self.frame_of(offset)
+        # reading forward within the current frame is cheaper than restarting it
+        if self.reader is None or offset < self.pos or frame != self.frame_of(self.pos):
+            decompressed, compressed = self.frames[frame]
+            self.fh.seek(compressed)
+            self.reader = self.dctx.stream_reader(self.fh, read_across_frames=True, closefd=False)
+            self.pos = decompressed
+        while self.pos < offset:
+            skipped = len(self.reader.read(min(offset - self.pos, CHUNK_SIZE)))
+            if not skipped:
+                break
+            self.pos += skipped
+        return self.pos
+
+    def readinto(self, b) -> int:
+        if self.reader is None:
+            self.seek(self.pos)
+        assert self.reader is not None
+        data = self.reader.read(len(b))
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.fh.close()
+        super().close()
@@ -0,0 +1,119 @@
+import dataclasses
+import json
+import sqlite3
+from chess import Board, Move
+from chess.engine import SimpleEngine, UciProtocol, Limit, InfoDict, PlayResult, PovScore, Cp, Mate
+from chess.polyglot import zobrist_hash
+from typing import Any, Dict, List, Optional, Tuple, Union, cast, overload
+
+# Kept identical in generator/ and tagger/, both can share the same store file (checked by tagger/test.py)
+
+def encode_info(info: InfoDict) -> Dict[str, Any]:
+    encoded: Dict[str, Any] = {k: v for k, v in info.items() if isinstance(v, (int, float, str))}
+    if "score" in info:
+        score = info["score"]
+        encoded["score"] = [score.turn, score.relative.score(), score.relative.mate()]
+    if "pv" in info:
+        encoded["pv"] = [move.uci() for move in info["pv"]]
+    return encoded
+
+def decode_info(encoded: Dict[str, Any]) -> InfoDict:
+    info: Dict[str, Any] = dict(encoded)
+    if "score" in encoded:
+        turn, cp, mate = encoded["score"]
+        info["score"] = PovScore(Cp(cp) if mate is None else Mate(mate), turn)
+    if "pv" in encoded:
+        info["pv"] = [Move.from_uci(uci) for uci in encoded["pv"]]
+    return cast(InfoDict, info)
+
+class EvalStore:
+    """
+    Engine results persisted in a sqlite file, keyed by position, search limit and engine,
+    so that re-running over the same games doesn't pay twice for the same searches.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.db = sqlite3.connect(path, timeout = 60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS evals (
+            hash INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            engine TEXT NOT NULL,
+            lim TEXT NOT NULL,
+            multipv INTEGER NOT NULL,
+            result TEXT NOT NULL,
+            PRIMARY KEY (hash, kind, engine, lim, multipv)
+        )""")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind: str, engine: Union[SimpleEngine, UciProtocol], board: Board, limit: Limit, multipv: Optional[int] = None) -> Tuple[int, str, str, str, int]:
+        h = zobrist_hash(board)
+        return (
+            h - (1 << 64) if h >= 1 << 63 else h, # sqlite integers are signed
+            kind,
+            engine.id.get("name", "?"),
+            json.dumps(dataclasses.astuple(limit)),
+            multipv or 0
+        )
+
+    def get(self, key: Tuple[int, str, str, str, int]) -> Optional[Any]:
+        row = self.db.execute(
+            "SELECT result FROM evals WHERE hash = ? AND kind = ? AND engine = ? AND lim = ? AND multipv = ?", key
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: Tuple[int, str, str, str, int], result: Any) -> None:
+        self.db.execute("INSERT OR REPLACE INTO evals VALUES (?, ?, ?, ?, ?, ?)", key + (json.dumps(result),))
+        self.db.commit()
+
+    def get_analyse(self, key: Tuple[int, str, str, str, int], multipv: Optional[int] = None) -> Optional[Union[InfoDict, List[InfoDict]]]:
+        stored = self.get(key)
+        if stored is None:
+            return None
+        infos = [decode_info(info) for info in stored]
+        return infos if multipv is not None else infos[0]
+
+    def put_analyse(self, key: Tuple[int, str, str, str, int], result: Union[InfoDict, List[InfoDict]]) -> None:
+        self.put(key, [encode_info(info) for info in (result if isinstance(result, list) else [result])])
+
+    def get_play(self, key: Tuple[int, str, str, str, int]) -> Optional[PlayResult]:
+        stored = self.get(key)
+        if stored is None:
+            return None
+        return PlayResult(Move.from_uci(stored[0]) if stored[0] else None, Move.from_uci(stored[1]) if stored[1] else None)
+
+    def put_play(self, key: Tuple[int, str, str, str, int], result: PlayResult) -> None:
+        self.put(key, [result.move.uci() if result.move else None, result.ponder.uci() if result.ponder else None])
+
+    @overload
+    def analyse(self, engine: SimpleEngine, board: Board, limit: Limit, multipv: None = None) -> InfoDict: ...
+    @overload
+    def analyse(self, engine: SimpleEngine, board: Board, limit: Limit, multipv: int) -> List[InfoDict]: ...
+    def analyse(self, engine: SimpleEngine, board: Board, limit: Limit, multipv: Optional[int] = None) -> Union[InfoDict, List[InfoDict]]:
+        "as `engine.analyse`, a single line without `multipv` and a list of lines with it"
+        key = self.key("analyse", engine, board, limit, multipv)
+        result = self.get_analyse(key, multipv)
+        if result is None:
+            result = engine.analyse(board, limit, multipv = multipv)
+            self.put_analyse(key, result)
+        return result
+
+    def play(self, engine: SimpleEngine, board: Board, limit: Limit) -> PlayResult:
+        key = self.key("play", engine, board, limit)
+        result = self.get_play(key)
+        if result is None:
+            result = engine.play(board, limit)
+            self.put_play(key, result)
+        return result
+
+    def stats(self) -> str:
+        return f"store {self.hits} hits / {self.misses} misses"
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,211 @@
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import socket
+import time
+import zlib
+from chess import Board, Move
+from chess.engine import SimpleEngine, Limit, InfoDict, PlayResult
+from evalstore import encode_info, decode_info
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Union
+
+# Kept identical in generator/ and tagger/, both can replay the same logs (checked by tagger/test.py)
+
+FLUSH_INTERVAL = 10 # seconds between flushes of the log to disk
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--record", help="log every engine search and its result to a file of this directory, one per process", metavar="DIR")
+    parser.add_argument("--replay", help="answer engine searches from the logs of this directory, searching and logging only the ones not there. The engine only starts on the first of them", metavar="DIR")
+
+def open_engine(args: argparse.Namespace, start: Callable[[], SimpleEngine], logger: logging.Logger) -> Any:
+    "the engine `start` returns, behind a `ReplayEngine` with `--record` or `--replay`"
+    if args.replay:
+        return ReplayEngine(start, args.replay, logger, replay = True)
+    if args.record:
+        return ReplayEngine(start, args.record, logger, replay = False)
+    return start()
+
+def search_key(kind: str, board: Board, limit: Limit, multipv: Optional[int], root_moves: Optional[List[Move]] = None) -> str:
+    limits = {k: v for k, v in vars(limit).items() if v is not None}
+    key = f"{kind} {board.fen()} {json.dumps(limits, sort_keys = True)} {multipv or 0}"
+    return key if root_moves is None else f"{key} {' '.join(sorted(move.uci() for move in root_moves))}"
+
+
+class ReplayedAnalysis:
+    "what `SimpleEngine.analysis` returns, from the final lines of a logged search"
+
+    def __init__(self, multipv: List[InfoDict]) -> None:
+        self.multipv = multipv
+        self.info = multipv[0] if multipv else {}
+
+    def __enter__(self) -> "ReplayedAnalysis":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+    def __iter__(self) -> Iterator[InfoDict]:
+        return iter(self.multipv)
+
+    def wait(self) -> None:
+        pass
+
+
+class RecordedAnalysis:
+    "a live `SimpleEngine.analysis`, logged when done"
+
+    def __init__(self, analysis: Any, done: Callable[[List[InfoDict]], None]) -> None:
+        self.analysis = analysis
+        self.done = done
+
+    def __enter__(self) -> "RecordedAnalysis":
+        self.analysis.__enter__()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.analysis.__exit__(*exc)
+
+    def __iter__(self) -> Iterator[InfoDict]:
+        return iter(self.analysis)
+
+    def wait(self) -> None:
+        self.analysis.wait()
+        self.done(self.multipv)
+
+    @property
+    def multipv(self) -> List[InfoDict]:
+        return self.analysis.multipv
+
+    @property
+    def info(self) -> InfoDict:
+        return self.analysis.info
+
+
+class ReplayEngine:
+    """
+    `SimpleEngine` stand-in logging each search (position, limit, multipv) and its result
+    to a gzipped json lines file, and, when replaying, answering the searches already
+    logged without the engine. Logs of all processes and runs in the directory are
+    replayed, so several iterations over the same games only pay for new searches.
+    Positions are told apart by FEN, as the store does by hash: the moves leading to
+    them aren't part of the key.
+    """
+
+    def __init__(self, start: Callable[[], SimpleEngine], directory: str, logger: logging.Logger, replay: bool) -> None:
+        self.start = start
+        self.logger = logger
+        self.live: Optional[SimpleEngine] = None
+        self.logged: Dict[str, Any] = {}
+        self.header: Dict[str, Any] = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok = True)
+        if replay:
+            self.load(directory)
+        self.path = os.path.join(directory, f"{socket.gethostname()}-{os.getpid()}.jsonl.gz")
+        self.log: Optional[gzip.GzipFile] = None
+        self.last_flush = time.monotonic()
+        if not replay:
+            self.live_engine() # all searches go to it
+
+    def load(self, directory: str) -> None:
+        for path in sorted(glob.glob(os.path.join(directory, "*.jsonl.gz"))):
+            try:
+                with gzip.open(path, "rt") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        if "engine" in entry:
+                            self.header = entry["engine"]
+                        else:
+                            self.logged[entry["key"]] = entry["result"]
+            except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError):
+                # the end of a log of a process that was killed
+                self.logger.warning(f"Truncated engine log {path}, replaying what comes before")
+        self.logger.info(f"Replaying {len(self.logged)} engine searches")
+
+    def live_engine(self) -> SimpleEngine:
+        "the engine, started when first needed"
+        if self.live is None:
+            self.live = self.start()
+            self.header = {"id": self.live.id, "options": list(self.live.options)}
+            self.write({"engine": self.header})
+        return self.live
+
+    @property
+    def id(self) -> Mapping[str, str]:
+        return self.header["id"] if self.header else self.live_engine().id
+
+    @property
+    def options(self) -> Any:
+        if self.live is None and self.header:
+            return {name: None for name in self.header["options"]}
+        return self.live_engine().options
+
+    def configure(self, options: Dict[str, Any]) -> None:
+        if self.live is not None:
+            self.live.configure(options)
+
+    def write(self, entry: Dict[str, Any]) -> None:
+        if self.log is None:
+            self.log = gzip.open(self.path, "ab")
+        self.log.write(json.dumps(entry).encode() + b"\n")
+        if time.monotonic() - self.last_flush > FLUSH_INTERVAL:
+            self.log.flush() # readable up to here even if the process is killed
+            self.last_flush = time.monotonic()
+
+    def replayed(self, key: str) -> Optional[Any]:
+        result = self.logged.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def record(self, key: str, result: Any) -> None:
+        self.logged[key] = result
+        self.write({"key": key, "result": result})
+
+    def analyse(self, board: Board, limit: Limit, multipv: Optional[int] = None, **kwargs: Any) -> Union[InfoDict, List[InfoDict]]:
+        key = search_key("analyse", board, limit, multipv, kwargs.get("root_moves"))
+        logged = self.replayed(key)
+        if logged is not None:
+            infos = [decode_info(info) for info in logged]
+            return infos if multipv is not None else infos[0]
+        result = self.live_engine().analyse(board, limit, multipv = multipv, **kwargs)
+        self.record(key, [encode_info(info) for info in (result if isinstance(result, list) else [result])])
+        return result
+
+    def analysis(self, board: Board, limit: Optional[Limit] = None, multipv: Optional[int] = None, **kwargs: Any) -> Any:
+        "searches stopped early are logged with the lines they had then"
+        key = search_key("analysis", board, limit or Limit(), multipv)
+        logged = self.replayed(key)
+        if logged is not None:
+            return ReplayedAnalysis([decode_info(info) for info in logged])
+        return RecordedAnalysis(
+            self.live_engine().analysis(board, limit, multipv = multipv, **kwargs),
+            lambda infos: self.record(key, [encode_info(info) for info in infos]))
+
+    def play(self, board: Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        key = search_key("play", board, limit, None)
+        logged = self.replayed(key)
+        if logged is not None:
+            return PlayResult(Move.from_uci(logged[0]) if logged[0] else None, Move.from_uci(logged[1]) if logged[1] else None)
+        result = self.live_engine().play(board, limit, **kwargs)
+        self.record(key, [result.move.uci() if result.move else None, result.ponder.uci() if result.ponder else None])
+        return result
+
+    def stats(self) -> str:
+        return f"replay {self.hits} hits / {self.misses} misses"
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.close()
+        if self.live is not None:
+            self.live.close()
+        self.logger.info(f"Engine {self.stats()}")
+
+    def quit(self) -> None:
+        self.close()
@@ -11,6 +11,10 @@ from model import Puzzle, TagKind
 import cook
 import chess.engine
 from zugzwang import zugzwang
+from evalstore import EvalStore
+from engine_profile import EngineProfile, profile_of, add_arguments as add_engine_arguments
+from replay import open_engine, add_arguments as add_replay_arguments
+from tablebase import open_tablebase, add_arguments as add_tablebase_arguments
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
@@ -24,6 +28,11 @@ def read(doc) -> Puzzle:
         node = node.add_main_variation(move)
     return Puzzle(doc["_id"], node.game(), int(doc["cp"]))
 
+def start_engine(executable: str, profile: EngineProfile) -> SimpleEngine:
+    engine = SimpleEngine.popen_uci(executable)
+    profile.configure(engine)
+    return engine
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='tagger.py', description='automatically tags lichess puzzles')
     parser.add_argument("--zug", "-z", help="only zugzwang", action="store_true")
@@ -32,6 +41,11 @@ if __name__ == "__main__":
     parser.add_argument("--all", "-a", help="don't skip existing", action="store_true")
     parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
     parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
+    parser.add_argument("--engine-threads", help="Threads of each engine (default 2 for --zug, 4 for --bad_mate)", type=int)
+    add_engine_arguments(parser)
+    add_replay_arguments(parser)
+    add_tablebase_arguments(parser)
+    parser.add_argument("--store", help="sqlite file where engine results are kept across runs, shared with the generator", metavar="FILE.sqlite")
     args = parser.parse_args()
 
     if args.zug:
@@ -40,8 +54,10 @@ if __name__ == "__main__":
             db = pymongo.MongoClient()['puzzler']
             round_coll = db['puzzle2_round']
             play_coll = db['puzzle2_puzzle']
-            engine = SimpleEngine.popen_uci(args.engine)
-            engine.configure({'Threads': 2})
+            profile = profile_of(args, args.engine_threads, EngineProfile(threads = 2))
+            engine = open_engine(args, lambda: start_engine(args.engine, profile), logger)
+            store = EvalStore(args.store) if args.store else None
+            tablebase = open_tablebase(args, logger)
             for doc in round_coll.aggregate([
                 {"$match":{"_id":{"$regex":"^lichess:"},"t":{"$nin":['+zugzwang','-zugzwang']}}},
                 {'$lookup':{'from':'puzzle2_puzzle','as':'puzzle','localField':'p','foreignField':'_id'}},
@@ -52,7 +68,8 @@ if __name__ == "__main__":
                         continue
                     puzzle = read(doc)
                     round_id = f'lichess:{puzzle.id}'
-                    zug = zugzwang(engine, puzzle)
+                    profile.new_game(engine)
+                    zug = zugzwang(engine, puzzle, store, tablebase)
                     if zug:
                         cook.log(puzzle)
                     round_coll.update_one(
@@ -77,8 +94,9 @@ if __name__ == "__main__":
             db = pymongo.MongoClient()['puzzler']
             bad_coll = db['puzzle2_bad_maybe']
             play_coll = db['puzzle2_puzzle']
-            engine = SimpleEngine.popen_uci('./stockfish')
-            engine.configure({'Threads': 4})
+            profile = profile_of(args, args.engine_threads, EngineProfile(threads = 4))
+            engine = open_engine(args, lambda: start_engine('./stockfish', profile), logger)
+            store = EvalStore(args.store) if args.store else None
             for doc in bad_coll.find({"bad": {"$exists":False}}):
                 try:
                     if ord(doc["_id"][4]) % threads != thread_id:
@@ -88,7 +106,9 @@ if __name__ == "__main__":
                         continue
                     puzzle = read(doc)
                     board = puzzle.mainline[len(puzzle.mainline) - 2].board()
-                    info = engine.analyse(board, multipv = 5, limit = chess.engine.Limit(nodes = 30_000_000))
+                    profile.new_game(engine)
+                    limit = chess.engine.Limit(nodes = 30_000_000)
+                    info = store.analyse(engine, board, limit, 5) if store else engine.analyse(board, multipv = 5, limit = limit)
                     bad = False
                     for score in [pv["score"].pov(puzzle.pov) for pv in info]:
                         if score < Mate(1) and score > Cp(250):
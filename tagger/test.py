@@ -1,5 +1,6 @@
 import unittest
 import logging
+import os
 import chess
 import util
 import cook
@@ -231,5 +232,14 @@ class TestUtil(unittest.TestCase):
             chess.Board("8/3P4/8/4N2b/7p/6N1/8/4K3 b - - 0 1"), parse_square("h5")
         ))
 
+class TestSharedModules(unittest.TestCase):
+
+    def test_same_as_generator(self):
+        # copies of the generator modules, so that each directory runs on its own
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ["evalstore.py", "engine_profile.py", "replay.py", "tablebase.py"]:
+            with open(os.path.join(here, name), "rb") as copy, open(os.path.join(here, "..", "generator", name), "rb") as original:
+                self.assertEqual(copy.read(), original.read(), f"tagger/{name} differs from generator/{name}")
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,10 +4,13 @@ import math
 from chess import Board, Move, Color
 from chess.engine import SimpleEngine, Score
 from model import Puzzle
+from evalstore import EvalStore
+from tablebase import Tablebase
+from typing import Optional
 
 engine_limit = chess.engine.Limit(depth = 30, time = 10, nodes = 12_000_000)
 
-def zugzwang(engine: SimpleEngine, puzzle: Puzzle) -> bool:
+def zugzwang(engine: SimpleEngine, puzzle: Puzzle, store: Optional[EvalStore] = None, tablebase: Optional[Tablebase] = None) -> bool:
     for node in puzzle.mainline[1::2]:
         board = node.board()
         if board.is_check():
@@ -15,19 +18,22 @@ def zugzwang(engine: SimpleEngine, puzzle: Puzzle) -> bool:
         if len(list(board.legal_moves)) > 15:
             continue
 
-        score = score_of(engine, board, not puzzle.pov)
+        score = score_of(engine, board, not puzzle.pov, store, tablebase)
 
         rev_board = node.board()
         rev_board.push(Move.null())
-        rev_score = score_of(engine, rev_board, not puzzle.pov)
+        rev_score = score_of(engine, rev_board, not puzzle.pov, store, tablebase)
 
         if win_chances(score) < win_chances(rev_score) - 0.3:
             return True
 
     return False
 
-def score_of(engine: SimpleEngine, board: Board, pov: Color):
-    info = engine.analyse(board, limit = engine_limit)
+def score_of(engine: SimpleEngine, board: Board, pov: Color, store: Optional[EvalStore] = None, tablebase: Optional[Tablebase] = None):
+    score = tablebase.score(board) if tablebase else None
+    if score is not None:
+        return score if board.turn == pov else -score
+    info = store.analyse(engine, board, engine_limit) if store else engine.analyse(board, limit = engine_limit)
     if "nps" in info:
         print(f'knps: {int(info["nps"] / 1000)} kn: {int(info["nodes"] / 1000)} depth: {info["depth"]} time: {info["time"]}')
     return info["score"].pov(pov)
@@ -44,5 +44,22 @@ export class SeenMongo {
   positionExists = (fen: string, move: string): Promise<boolean> =>
     this.puzzleColl.countDocuments({ fen: fen, 'moves.0': move }).then(n => n > 0);
 
+  seenPositions = async (ids: string[]): Promise<string[]> => {
+    const pairs = ids.map(id => id.split(':')).filter(p => p.length == 2);
+    if (!pairs.length) return [];
+    const found = await this.puzzleColl
+      .find({ $or: pairs.map(([fen, move]) => ({ fen: fen, 'moves.0': move })) }, { projection: { fen: 1, moves: 1 } })
+      .toArray();
+    return found.map(p => `${p.fen}:${p.moves[0]}`);
+  };
+
+  seenGames = (ids: string[]): Promise<string[]> =>
+    this.seenColl
+      .find({ _id: { $in: ids } } as any)
+      .toArray()
+      .then(docs => docs.map(d => d._id as any as string));
+
+  allPositions = () => this.puzzleColl.find({}, { projection: { fen: 1, moves: { $slice: 1 } } });
+
   set = (id: string) => this.seenColl.insertOne({ _id: id } as any).catch(() => {});
 }